@@ -10,15 +10,118 @@ import os as os
 import subprocess as sub
 import yaml as yaml
 import json as json
-from openapi_core import Spec
-from openapi_core import validate_request
-from openapi_core import unmarshal_request
-from openapi_core.testing import MockRequest
+import hashlib as hashlib
+
+#Note: openapi_core is imported only when a validation actually runs, as
+#it dominates the start-up time of short jobs
+
+#===============================#
+# CACHED SPECIFICATIONS LOADING #
+#===============================#
+#Compiled specifications already loaded in this process, by file hash
+loaded_specs = {}
+
+def file_hash(file_path):
+    """SHA-256 hex digest of the content of a file."""
+    with open(file_path, 'rb') as hashed_file:
+        return hashlib.sha256(hashed_file.read()).hexdigest()
+
+def write_json_atomically(file_path, data):
+    """Write data as JSON so that concurrent readers never see a partial file."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = file_path + '.tmp%d' % os.getpid()
+    with open(tmp_path, 'w') as outfile:
+        json.dump(data, outfile)
+    os.replace(tmp_path, file_path)
+
+def load_specifications_dict(specs_file_path, cache_dir=None):
+    """Parsed specifications as a plain dict, from the cache when available."""
+    if cache_dir is not None:
+        cached_specs = os.path.join(cache_dir, 'spec_' + file_hash(specs_file_path) + '.json')
+        if os.path.exists(cached_specs):
+            with open(cached_specs, 'r') as spec_file:
+                return json.load(spec_file)
+    with open(specs_file_path, 'r') as spec_file:
+        return yaml.safe_load(spec_file)
+
+def load_specifications(specs_file_path, cache_dir=None):
+    """Compiled specifications, reused within the process and cached on disk.
+    
+    The cache is keyed by the hash of the specifications file. Specifications
+    found in the cache have already been checked, so they are not validated
+    against the OpenAPI schema again.
+    """
+    from openapi_core import Spec
+    digest = file_hash(specs_file_path)
+    if digest in loaded_specs:
+        return loaded_specs[digest]
+    cached_specs = os.path.join(cache_dir, 'spec_' + digest + '.json') if cache_dir is not None else None
+    if cached_specs is not None and os.path.exists(cached_specs):
+        with open(cached_specs, 'r') as spec_file:
+            openapi_specs = Spec.from_dict(json.load(spec_file), validator=None)
+    else:
+        with open(specs_file_path, 'r') as spec_file:
+            openapi_specs = Spec.from_file(spec_file)
+        if cached_specs is not None:
+            with open(specs_file_path, 'r') as spec_file:
+                write_json_atomically(cached_specs, yaml.safe_load(spec_file))
+    loaded_specs[digest] = openapi_specs
+    return openapi_specs
+
+#==========================#
+# OPENAPI DATA VALIDATION  #
+#==========================#
+def validate_input_data(openapi_specs, input_spec_path, data, operation="PUT"):
+    """Validate already loaded input data against loaded specifications.
+    
+    Returns the unmarshaled body (None if invalid) and a string listing the
+    validation errors (empty if valid).
+    """
+    from openapi_core import unmarshal_request
+    from openapi_core.testing import MockRequest
+    
+    #Define the request object
+    request = MockRequest(
+        host_url='/',
+        method=operation,
+        path=input_spec_path,
+        data=json.dumps(data)
+    )
+    
+    #To store error messages if there are
+    errors = "" 
+    valid_body = None
+    
+    # Validate the request
+    #----------------------
+    try: #use 'try' to not interrupt the program in case 'validate_request()' finds errors
+        #~Validate parameters that are properly defined
+        valid_request = unmarshal_request(spec=openapi_specs, request=request)
+        valid_body = valid_request.body
+    
+    # Raise error message if problem in validation
+    #----------------------------------------------
+    except Exception as e:
+        for error in e.__cause__.schema_errors:
+            #~Skip "None for not nullable" error as it always come double with another error, for when no value is given for a property
+            if error.message != "None for not nullable":
+                #~For errors associated with a given defined property
+                if len(error.relative_path) != 0:
+                    errors += "\n   ['"+ error.relative_path[0] +"'] -> "+ error.message
+                else:
+                    errors += "\n  -> "+ error.message
+    
+    return valid_body, errors
 
 #=========================#
 # OPENAPI INPUT VALIDATOR #
 #=========================#
-def OpenAPI_validator(specs_file_path, input_file_path, verbose=False, print_valid=True):    
+def OpenAPI_validator(specs_file_path, input_file_path, verbose=False, print_valid=True, cache_dir=None):    
+    """Validate an input file against the specifications.
+    
+    With a cache_dir, inputs already validated against the same
+    specifications are not validated again.
+    """
 
     api_path = os.path.abspath(os.path.dirname(__file__))
     out_path = api_path[:-3] + "output/"
@@ -41,8 +144,7 @@ def OpenAPI_validator(specs_file_path, input_file_path, verbose=False, print_val
     
     # Reading OpenAPI specifications
     #--------------------------------
-    with open(specs_file_path, 'r') as spec_file:
-        openapi_specs = Spec.from_file(spec_file)
+    openapi_specs = load_specifications_dict(specs_file_path, cache_dir)
     
     #~Extract name of input file
     input_file = input_file_path[input_file_path.rfind('/')+1:]
@@ -75,34 +177,20 @@ def OpenAPI_validator(specs_file_path, input_file_path, verbose=False, print_val
     if 'output/' in input_file_path:
         operation = "GET"
     
-    #Define the request object
-    request = MockRequest(
-        host_url='/',
-        method=operation,
-        path=input_spec_path,
-        data=json.dumps(data)
-    )
-    
-    #To store error messages if there are
-    errors = "" 
-    
-    # Validate the request
-    #----------------------
-    try: #use 'try' to not interrupt the program in case 'validate_request()' finds errors
-        #~Validate parameters that are properly defined
-        valid_request = unmarshal_request(spec=openapi_specs, request=request)
-    
-    # Raise error message if problem in validation
-    #----------------------------------------------
-    except Exception as e:
-        for error in e.__cause__.schema_errors:
-            #~Skip "None for not nullable" error as it always come double with another error, for when no value is given for a property
-            if error.message != "None for not nullable":
-                #~For errors associated with a given defined property
-                if len(error.relative_path) != 0:
-                    errors += "\n   ['"+ error.relative_path[0] +"'] -> "+ error.message
-                else:
-                    errors += "\n  -> "+ error.message
+    #Reuse the result of a previous validation of the same input and specifications
+    cached_input = None
+    if cache_dir is not None:
+        with open(input_file_path, 'rb') as input_file:
+            input_key = hashlib.sha256((file_hash(specs_file_path) + operation).encode() + input_file.read()).hexdigest()
+        cached_input = os.path.join(cache_dir, 'valid_' + input_key + '.json')
+    if cached_input is not None and os.path.exists(cached_input):
+        with open(cached_input, 'r') as valid_file:
+            valid_body, errors = json.load(valid_file), ""
+    else:
+        #Validate the input against the specifications
+        valid_body, errors = validate_input_data(load_specifications(specs_file_path, cache_dir), input_spec_path, data, operation)
+        if errors == "" and cached_input is not None:
+            write_json_atomically(cached_input, valid_body)
     
     # Print message for validation 
     #------------------------------
@@ -135,7 +223,7 @@ def OpenAPI_validator(specs_file_path, input_file_path, verbose=False, print_val
     
         #~Create new valid input file
         with open(valid_input_file, "w") as valid_input:
-            yaml.safe_dump(valid_request.body, valid_input)
+            yaml.safe_dump(valid_body, valid_input)
         
     # Returning name of (validated) input file
     #------------------------------------------
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#-----------------------------------------------------------------------------------------------
+# |Gaussian Process Generator benchmarks|
+# ----------------
+# Measures wall time, throughput (samples per second) and peak memory of:
+# - GaussianProcessCrossSection (factorization + batched sampling)
+# - tabulate_gp_cross_section (generation + writing)
+# - plot_gp_cross_section (loading + rendering)
+# over a matrix of grid sizes, sample counts and backend options. Every case
+# runs in its own process, so peak memory is measured per case. Results are
+# appended to a JSON history, and 'compare' flags regressions between runs.
+#
+# Ex.:
+# $> python benchmarks/benchmark.py run --matrix quick --label my-change
+# $> python benchmarks/benchmark.py compare --threshold 0.1
+################################################################################################
+
+import sys as sys
+import os as os
+import json as json
+import time as time
+import platform as platform
+import argparse as argparse
+import tempfile as tempfile
+import itertools as itertools
+import subprocess as sub
+import multiprocessing as multiprocessing
+
+# Determine current path to define all other paths relative to it
+pwd = os.path.abspath(os.path.dirname(__file__))
+home_path = pwd[:pwd.rindex('/') + 1]
+src_path = os.path.join(home_path, 'src/')
+history_path = os.path.join(pwd, 'history.json')
+
+# Benchmarks always render off-screen
+os.environ['MPLBACKEND'] = 'Agg'
+sys.path.append(src_path)
+
+# Case matrices: grid sizes, sample counts and options of each stage. Circulant
+# cases use a short correlation length l, as the default l = 1 needs an
+# embedding larger than the sampler allows on small grids
+MATRICES = {
+    "quick": {
+        "N": [100, 1000],
+        "samples": [100, 10000],
+        "generator": [{"sampler": "cholesky"}, {"sampler": "circulant", "l": 0.05}, {"sampler": "lowrank"}],
+        "tabulator": [{"sampler": "cholesky", "output_format": "text"}, {"sampler": "cholesky", "output_format": "binary"}],
+        "plotter": [{"plot_mode": "lines"}, {"plot_mode": "density"}],
+    },
+    "full": {
+        "N": [100, 1000, 10000, 100000],
+        "samples": [100, 10000, 1000000],
+        "generator": [{"sampler": "cholesky"}, {"sampler": "circulant", "l": 0.05}, {"sampler": "lowrank"}],
+        "tabulator": [{"sampler": "cholesky", "output_format": "text"}, {"sampler": "cholesky", "output_format": "binary"},
+                      {"sampler": "circulant", "l": 0.05, "output_format": "binary"}],
+        "plotter": [{"plot_mode": "lines"}, {"plot_mode": "density"}],
+    },
+}
+
+# Samples generated at a time, bounded so a chunk holds at most this many values
+# (ten times fewer for text output, whose formatting needs far more memory)
+CHUNK_VALUES = 10 ** 7
+
+def peak_rss_MB():
+    """Peak resident set size of the current process in MB."""
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def chunk_size(N, options):
+    """Samples per chunk for a grid of N points."""
+    values = CHUNK_VALUES // 10 if options.get("output_format") == "text" else CHUNK_VALUES
+    return max(1, values // N)
+
+def case_memory_MB(stage, N, samples, options):
+    """Rough memory footprint of a case, used to skip infeasible ones.
+
+    Circulant cases have no N x N cost, as they fail instead of falling back
+    to Cholesky (see build_GP).
+    """
+    dense = 3 * 8 * N ** 2 if options.get("sampler", "cholesky") in ["cholesky", "lowrank"] else 0
+    chunk = 8 * 8 * min(samples, chunk_size(N, options)) * N
+    # Line plots hold several copies of every value of the ensemble
+    if stage == "plotter":
+        dense = 0
+        chunk = 8 * (8 if options["plot_mode"] == "lines" else 3) * samples * N
+    return (dense + chunk) / 1024 ** 2
+
+def build_GP(N, options):
+    """GP of a case, with the sampler and correlation length of its options.
+
+    A circulant sampler that would fall back to Cholesky raises instead, so
+    that circulant cases never time (or allocate) a dense factorization.
+    """
+    import warnings
+    from GaussianProcessCrossSectionGenerator import GaussianProcessCrossSection
+    with warnings.catch_warnings():
+        warnings.filterwarnings('error', message='Circulant embedding')
+        return GaussianProcessCrossSection(N=N, l=options.get("l", 1.0), sampler=options.get("sampler", "cholesky"))
+
+def generate_ensemble(N, samples, out_path):
+    """Write the binary ensemble plotted by the plotter cases."""
+    from GaussianProcessCrossSectionTabulator import tabulate_gp_cross_section
+    # Plotter cases are not charged for a factorization (see case_memory_MB)
+    GP = build_GP(N, {"sampler": "circulant", "l": 0.05})
+    tabulate_gp_cross_section(GP, out_path, samples, "binary", chunk_size(N, {}), seed=0)
+
+def run_case(stage, N, samples, options, out_path, results):
+    """Run one case in the current process and put its measurements in results."""
+    import numpy as np
+    from GaussianProcessCrossSectionTabulator import tabulate_gp_cross_section
+    if stage == "plotter":
+        from GaussianProcessCrossSectionPlotter import plot_gp_cross_section
+    base_rss = peak_rss_MB()
+    setup_time = 0.0
+    GP = None
+    start = time.perf_counter()
+    if stage == "generator":
+        GP = build_GP(N, options)
+        setup_time = time.perf_counter() - start
+        rng = np.random.default_rng(0)
+        for chunk_start in range(0, samples, chunk_size(N, options)):
+            n = min(chunk_size(N, options), samples - chunk_start)
+            GP.calculateBatch(np.ones(n), rng.random(n), rng)
+    elif stage == "tabulator":
+        GP = build_GP(N, options)
+        setup_time = time.perf_counter() - start
+        tabulate_gp_cross_section(GP, out_path, samples, options["output_format"], chunk_size(N, options), seed=0)
+    elif stage == "plotter":
+        plot_gp_cross_section(out_path, "binary", options["plot_mode"])
+    wall_time = time.perf_counter() - start
+    result = {"wall_time": wall_time, "setup_time": setup_time, "throughput": samples / wall_time,
+              "peak_rss_MB": peak_rss_MB(), "base_rss_MB": base_rss}
+    if GP is not None:
+        # Sampler actually used
+        result["sampler"] = GP.sampler
+    results.put(result)
+
+def run_in_process(target, args, timeout):
+    """Run target(*args) in a fresh process; return an error message or None."""
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=target, args=args)
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.terminate()
+        return "timeout after %g s" % timeout
+    if process.exitcode != 0:
+        return "exit code %d" % process.exitcode
+    return None
+
+def measure(stage, N, samples, options, timeout):
+    """Run a case in a fresh process and return its measurements (or an error)."""
+    results = multiprocessing.get_context('spawn').Queue()
+    with tempfile.TemporaryDirectory() as out_path:
+        # The ensemble to plot is generated in its own process, outside of the measurement
+        error = run_in_process(generate_ensemble, (N, samples, out_path), timeout) if stage == "plotter" else None
+        error = error or run_in_process(run_case, (stage, N, samples, options, out_path, results), timeout)
+    if error is not None:
+        return {"error": error}
+    return results.get()
+
+def case_key(case):
+    """Identifier of a case, used to match cases between runs."""
+    return json.dumps([case["stage"], case["N"], case["samples"], case["options"]], sort_keys=True)
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as history_file:
+        return json.load(history_file)
+
+def git_commit():
+    try:
+        return sub.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=home_path, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def run_benchmarks(args):
+    matrix = MATRICES[args.matrix]
+    stages = args.stages.split(',')
+    run = {"timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'), "label": args.label, "commit": git_commit(),
+           "matrix": args.matrix, "host": {"platform": platform.platform(), "python": platform.python_version(),
+                                           "cpus": os.cpu_count()}, "cases": []}
+    for stage in stages:
+        for N, samples, options in itertools.product(matrix["N"], matrix["samples"], matrix[stage]):
+            case = {"stage": stage, "N": N, "samples": samples, "options": options}
+            if case_memory_MB(stage, N, samples, options) > args.max_memory_MB:
+                case["skipped"] = "estimated memory above %g MB" % args.max_memory_MB
+            else:
+                case.update(measure(stage, N, samples, options, args.timeout))
+            run["cases"].append(case)
+            print("%-10s N=%-7d samples=%-8d %-45s %s" % (stage, N, samples, json.dumps(options),
+                  case.get("skipped") or case.get("error") or "%.3f s, %.0f samples/s, %.0f MB peak" %
+                  (case["wall_time"], case["throughput"], case["peak_rss_MB"])))
+    history = load_history(args.history)
+    history.append(run)
+    with open(args.history, 'w') as history_file:
+        json.dump(history, history_file, indent=1)
+    print("[benchmark.py]> Results appended to %s" % args.history)
+
+def compare_benchmarks(args):
+    """Compare two runs of the history; return the number of regressions."""
+    history = load_history(args.history)
+    if len(history) < 2:
+        print("[benchmark.py]> At least two runs are needed in %s" % args.history)
+        return 0
+    baseline, candidate = history[args.baseline], history[args.candidate]
+    print("[benchmark.py]> Baseline %s (%s) vs candidate %s (%s)" % (baseline["timestamp"], baseline["label"],
+                                                                   candidate["timestamp"], candidate["label"]))
+    baseline_cases = {case_key(case): case for case in baseline["cases"] if "wall_time" in case}
+    regressions = 0
+    for case in candidate["cases"]:
+        reference = baseline_cases.get(case_key(case))
+        if reference is None or "wall_time" not in case:
+            continue
+        time_ratio = case["wall_time"] / reference["wall_time"]
+        memory_ratio = case["peak_rss_MB"] / reference["peak_rss_MB"]
+        flag = ""
+        if time_ratio > 1 + args.threshold or memory_ratio > 1 + args.threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        print("%-10s N=%-7d samples=%-8d %-45s time x%.2f  memory x%.2f  %s" % (case["stage"], case["N"], case["samples"],
+              json.dumps(case["options"]), time_ratio, memory_ratio, flag))
+    print("[benchmark.py]> %d regression(s) beyond %.0f%%" % (regressions, 100 * args.threshold))
+    return regressions
+
+#======#
+# MAIN #
+#======#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the generator, tabulator and plotter")
+    parser.add_argument('--history', default=history_path, help="JSON file holding the benchmark history")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="run the benchmark matrix and append the results to the history")
+    run_parser.add_argument('--matrix', choices=sorted(MATRICES), default='quick')
+    run_parser.add_argument('--stages', default='generator,tabulator,plotter', help="comma-separated stages to run")
+    run_parser.add_argument('--label', default='', help="free-form label stored with the run")
+    run_parser.add_argument('--max-memory-MB', type=float, default=4096, help="skip cases estimated to need more")
+    run_parser.add_argument('--timeout', type=float, default=1800, help="time limit of each case in seconds")
+    compare_parser = commands.add_parser('compare', help="compare two runs and flag regressions")
+    compare_parser.add_argument('--baseline', type=int, default=-2, help="index of the baseline run in the history")
+    compare_parser.add_argument('--candidate', type=int, default=-1, help="index of the candidate run in the history")
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help="relative slowdown or memory growth flagged")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_benchmarks(args)
+    else:
+        sys.exit(1 if compare_benchmarks(args) > 0 else 0)
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+def entry_size(path):
+    """Size in bytes of a cache entry (file or directory)."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def remove_entry(path):
+    """Remove a cache entry directory and its contents."""
+    for root, dirs, files in os.walk(path, topdown=False):
+        for f in files:
+            os.remove(os.path.join(root, f))
+        for d in dirs:
+            os.rmdir(os.path.join(root, d))
+    os.rmdir(path)
+
+def evict_least_recently_used(cache_dir, max_bytes):
+    """Remove the least recently used entries of cache_dir until it fits in max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        # Skip partially written entries from other processes
+        if name.startswith('tmp'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.path.getmtime(path), entry_size(path), path))
+        except FileNotFoundError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            if os.path.isdir(path):
+                remove_entry(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted.append(path)
+    return evicted
+
+class CholeskyCache:
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        """On-disk LRU cache of Cholesky factors stored as .npy files."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Statistics reported at the end of a run
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
+        self.store_time = 0.0
+
+    def key(self, sigma, l, kappa, xi, dtype):
+        """Content-addressed key for the factor of a given grid and kernel."""
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(sigma, dtype=np.float64).tobytes())
+        digest.update(repr((float(l), float(kappa), float(xi), np.dtype(dtype).str)).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key):
+        """Return the memory-mapped factor for key, or None on a miss."""
+        start = time.perf_counter()
+        try:
+            LMatrix = np.load(self.path(key), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        # Mark the entry as recently used
+        os.utime(self.path(key))
+        self.hits += 1
+        self.load_time += time.perf_counter() - start
+        return LMatrix
+
+    def store(self, key, LMatrix):
+        """Write the factor atomically, then trim the cache to its size limit."""
+        start = time.perf_counter()
+        tmp_path = os.path.join(self.cache_dir, 'tmp%d_%s.npy' % (os.getpid(), key))
+        np.save(tmp_path, LMatrix)
+        self.store_time += time.perf_counter() - start
+        self.commit(key, None, tmp_path)
+
+    def open(self, key, shape):
+        """Writable memory map of a new float64 entry, returned with its temporary path (see commit)."""
+        tmp_path = os.path.join(self.cache_dir, 'tmp%d_%s.npy' % (os.getpid(), key))
+        return np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=shape), tmp_path
+
+    def commit(self, key, LMatrix, tmp_path):
+        """Publish an entry written to tmp_path and trim the cache.
+
+        If LMatrix is the memory map of tmp_path, the entry is returned
+        mapped again from its final path.
+        """
+        start = time.perf_counter()
+        if LMatrix is not None:
+            LMatrix.flush()
+        os.replace(tmp_path, self.path(key))
+        if LMatrix is not None:
+            LMatrix = np.load(self.path(key), mmap_mode='r')
+        evict_least_recently_used(self.cache_dir, self.max_bytes)
+        self.store_time += time.perf_counter() - start
+        return LMatrix
+
+    def report(self):
+        """Summary of cache usage."""
+        return {"hits": self.hits, "misses": self.misses,
+                "load_time": round(self.load_time, 6), "store_time": round(self.store_time, 6)}
+
+# Runtime parameters that do not change the results of a run
+RESULT_INDEPENDENT_PARAMETERS = ['workers', 'instrumentation', 'profile_stage', 'cholesky_cache_size_MB',
+                                 'result_cache_size_MB', 'checkpoint', 'pipeline']
+
+def code_version(paths):
+    """Digest of the .py and .yaml files in the given directories (changes with any edit of the code)."""
+    digest = hashlib.sha256()
+    for path in paths:
+        for name in sorted(os.listdir(path)):
+            if name.endswith(('.py', '.yaml')):
+                digest.update(name.encode())
+                with open(os.path.join(path, name), 'rb') as infile:
+                    digest.update(infile.read())
+    return digest.hexdigest()
+
+def run_key(config, version):
+    """Key of a run of a validated config (seed included) by the given code version."""
+    config = dict(config)
+    config['runtime_parameters'] = {name: value for name, value in config.get('runtime_parameters', {}).items()
+                                    if name not in RESULT_INDEPENDENT_PARAMETERS}
+    digest = hashlib.sha256()
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    digest.update(version.encode())
+    return digest.hexdigest()
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        """On-disk LRU cache of the output files of whole runs, one directory per run."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key, out_path):
+        """Copy the outputs cached for key into out_path; False on a miss."""
+        entry_path = self.path(key)
+        if not os.path.isdir(entry_path):
+            return False
+        # Mark the entry as recently used
+        os.utime(entry_path)
+        for root, _, files in os.walk(entry_path):
+            target = os.path.join(out_path, os.path.relpath(root, entry_path))
+            os.makedirs(target, exist_ok=True)
+            for f in files:
+                # Copies, not links: later runs overwrite their outputs in place
+                shutil.copyfile(os.path.join(root, f), os.path.join(target, f))
+        return True
+
+    def store(self, key, out_path, since, exclude=()):
+        """Cache the files of out_path modified since the given time, then trim the cache.
+
+        Files in exclude (relative to out_path) are left out, as are runs
+        whose outputs alone exceed the size limit.
+        """
+        outputs = []
+        for root, _, files in os.walk(out_path):
+            for f in files:
+                path = os.path.join(root, f)
+                if os.path.relpath(path, out_path) not in exclude and os.path.getmtime(path) >= since:
+                    outputs.append(path)
+        if not outputs or sum(os.path.getsize(path) for path in outputs) > self.max_bytes:
+            return False
+        tmp_path = os.path.join(self.cache_dir, 'tmp%d_%s' % (os.getpid(), key))
+        for path in outputs:
+            target = os.path.join(tmp_path, os.path.relpath(path, out_path))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+        try:
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            # Stored by another process in the meantime
+            remove_entry(tmp_path)
+        evict_least_recently_used(self.cache_dir, self.max_bytes)
+        return True
@@ -1,40 +1,589 @@
+import os
+import copy
+import json
+import weakref
+import tempfile
+import warnings
 import numpy as np
+from GaussianProcessCrossSectionInstrumentation import stage
+
+# Quantities constraints can be set on (see setConstraints)
+CONSTRAINT_QUANTITIES = ['phi', 'dsigma_dt', 'time']
+
+# Iterations, tolerance (in log(dsigma/dt) or time ratio) and finite
+# difference step of the per-sample solve of conditionNoise
+CONSTRAINT_ITERATIONS = 50
+CONSTRAINT_TOLERANCE = 1e-8
+CONSTRAINT_STEP = 1e-6
+
+# Largest number of complex values the circulant sampler transforms at a time
+CIRCULANT_BLOCK_VALUES = 2 ** 22
+
+# Largest circulant embedding, in units of N; larger embeddings (long
+# correlation lengths) sample slower than Cholesky, which is used instead.
+# Above MAX_IN_MEMORY_POINTS, where Cholesky needs a factor on disk, the
+# embedding may grow up to CIRCULANT_MAX_LARGE_EMBEDDING N
+CIRCULANT_MAX_EMBEDDING = 8
+CIRCULANT_MAX_LARGE_EMBEDDING = 64
+
+# Floating point types samples can be computed and stored in
+PRECISIONS = ['float64', 'float32']
+
+# Where the covariance matrix is assembled and factorized: 'dense' builds it at
+# once, 'blocked' tile by tile in a single N x N buffer, 'disk' in a memory map
+FACTORIZATION_MEMORY = ['dense', 'blocked', 'disk']
+
+# Largest number_of_points_in_domain of a config whose covariance is assembled
+# densely (about four N x N matrices); larger grids need factorization_memory
+# 'blocked' (one) or 'disk' (a memory map), or the circulant sampler
+MAX_IN_MEMORY_POINTS = 1000
+
+def factorization_key(config):
+    """Key of everything in a validated config that determines the GP factorization.
+
+    Configs with the same key can share one GP through copyForConfig.
+    """
+    sampling_parameters = config.get('sampling_parameters', {})
+    runtime_parameters = config.get('runtime_parameters', {})
+    key = json.dumps([config.get('GP_parameters', {}), sampling_parameters.get('number_of_points_in_domain'),
+                      sampling_parameters.get('sigma_ratio'), runtime_parameters.get('sampler'),
+                      runtime_parameters.get('rank'), runtime_parameters.get('tolerance'),
+                      runtime_parameters.get('precision', 'float64'),
+                      runtime_parameters.get('factorization_memory', 'dense'),
+                      sampling_parameters.get('grid', 'uniform'), sampling_parameters.get('grid_tolerance'),
+                      sampling_parameters.get('max_points_in_domain'), sampling_parameters.get('output_sigma')], sort_keys=True)
+    # An adaptive grid is refined around the constraints, so it depends on them
+    if sampling_parameters.get('grid', 'uniform') == 'adaptive':
+        key += json.dumps(config.get('constraint_parameters'), sort_keys=True)
+    return key
+
+def cholesky_in_place(A, block_size=512):
+    """Overwrite the symmetric positive definite A with its lower Cholesky factor.
+
+    Left-looking blocked algorithm: only the lower triangle of A is read and
+    the working set is one column panel of block_size columns, so A can be
+    a memory map larger than RAM. The upper triangle is zeroed.
+    """
+    N = A.shape[0]
+    for start in range(0, N, block_size):
+        stop = min(start + block_size, N)
+        panel = A[start:, start:stop]
+        # Updates from the columns already factorized
+        if start > 0:
+            panel -= A[start:, :start] @ A[start:stop, :start].T
+        diagonal = np.linalg.cholesky(panel[:stop - start])
+        panel[:stop - start] = diagonal
+        if stop < N:
+            panel[stop - start:] = np.linalg.solve(diagonal, panel[stop - start:].T).T
+        A[start:stop, stop:] = 0
+    return A
 
 class GaussianProcessCrossSection:
-    def __init__(self):
-        """Initialize Gaussian Process Cross-section with default parameters."""
+    def __init__(self, N=100, sigma_ratio=(0.01, 1), l=1.0, kappa=10.0, xi=1e-6,
+                 sigma_0=0.0, sigma_f=1.0, t_prod=0.0, t_form=1.0, cache=None,
+                 sampler='cholesky', rank=None, tolerance=None, sigma=None, output_sigma=None,
+                 precision='float64', factorization_memory='dense', block_size=512):
+        """Initialize Gaussian Process Cross-section with default parameters.
+
+        The domain is N uniform points over sigma_ratio, unless an explicit
+        (e.g. adaptive) sigma grid is given. Samples are returned on
+        output_sigma if given (see resampleBatch), and on the domain otherwise.
+        precision is the floating point type of the sampling, integration
+        and returned samples; factorizations are always computed in float64
+        and cast afterwards (see checkPrecision). With factorization_memory
+        'blocked' or 'disk', the covariance matrix is assembled block_size
+        rows at a time and factorized in place, in memory or in a memory map
+        (in the Cholesky cache if any, in a temporary file otherwise).
+        """
         # Model hyperparameters
-        self.N = 100                           # Number of points in the domain
-        self.sigma = np.linspace(0.01, 1, self.N)  # Cross section domain
-        self.l = 1.0                            # Correlation length (~10% of the domain)
-        self.kappa = 10.0                      # Amplitude
-        self.xi = 1e-6                          # Small noise term
+        if sigma is None:
+            self.N = N                          # Number of points in the domain
+            self.sigma = np.linspace(sigma_ratio[0], sigma_ratio[1], self.N)  # Cross section domain
+        else:
+            self.sigma = np.asarray(sigma, dtype=np.float64)
+            self.N = len(self.sigma)
+        # Grid the samples are returned on
+        self.outputSigma = self.sigma if output_sigma is None else np.asarray(output_sigma, dtype=np.float64)
+        self.l = l                              # Correlation length (~10% of the domain)
+        self.kappa = kappa                      # Amplitude
+        self.xi = xi                            # Small noise term
         # Model parameters
-        self.sigma_0 = 0.0                      # Initial cross section
-        self.sigma_f = 1.0                      # Final cross section
-        self.t_prod = 0.0                       # Production time
-        self.t_form = 1.0                       # Formation time
-        
-        # Compute covariance matrix and Cholesky decomposition
-        self.SigmaMatrix = self.calculateCovarianceSigma()
-        self.LMatrix = self.calculateCholeskyL()
-
-    def calculateCovarianceSigma(self):
-        """Calculate the covariance matrix for the cross-section."""
-        # Create a matrix with pairwise differences and apply the function element-wise
-        sigma_i = self.sigma[:, np.newaxis]
-        sigma_j = self.sigma[np.newaxis, :]
-        return self.kappa ** 2 * np.exp(-0.5 * ((sigma_i - sigma_j) / self.l) ** 2)
+        self.sigma_0 = sigma_0                  # Initial cross section
+        self.sigma_f = sigma_f                  # Final cross section
+        self.t_prod = t_prod                    # Production time
+        self.t_form = t_form                    # Formation time
+        # Optional on-disk cache of Cholesky factors
+        self.cache = cache
+        # Sampler backend: 'cholesky', 'circulant' or 'lowrank'
+        self.sampler = sampler
+        self.rank = rank                        # Number of eigenmodes kept by 'lowrank'
+        self.tolerance = tolerance              # Discarded variance fraction allowed by 'lowrank'
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision '%s'" % precision)
+        self.dtype = np.dtype(precision)        # Type of the samples
+        if factorization_memory not in FACTORIZATION_MEMORY:
+            raise ValueError("Unknown factorization memory '%s'" % factorization_memory)
+        self.factorization_memory = factorization_memory
+        self.block_size = block_size            # Rows and columns of the covariance handled at a time
+
+        self.SigmaMatrix = None
+        self.LMatrix = None
+        # Estimated integration error of an adaptive grid (see from_config)
+        self.gridError = None
+        self.gridTolerance = None
+        # Constraints the samples are conditioned on (see setConstraints)
+        self.constraintIndices = None
+        if self.sampler == 'circulant':
+            # Square root of the eigenvalues of the circulant embedding
+            self.circulantRoot = self.calculateCirculantEmbedding()
+            if self.circulantRoot is None:
+                self.sampler = 'cholesky'
+                if self.N > MAX_IN_MEMORY_POINTS and self.factorization_memory == 'dense':
+                    warnings.warn("Factorizing on disk, as %d points do not fit a dense covariance." % self.N)
+                    self.factorization_memory = 'disk'
+            else:
+                self.circulantRoot = self.circulantRoot.astype(self.dtype, copy=False)
+        elif self.sampler == 'lowrank':
+            # Leading eigenmodes scaled by the square root of their eigenvalues
+            self.lowRankFactor = self.calculateLowRankFactor().astype(self.dtype, copy=False)
+        elif self.sampler != 'cholesky':
+            raise ValueError("Unknown sampler '%s'" % sampler)
+        if self.sampler == 'cholesky':
+            # Compute covariance matrix and Cholesky decomposition
+            self.LMatrix = self.calculateCholeskyL().astype(self.dtype, copy=False)
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """Build a GP from a validated config.yaml dictionary."""
+        GP_parameters = config.get('GP_parameters', {})
+        physics_parameters = config.get('physics_parameters', {})
+        sampling_parameters = config.get('sampling_parameters', {})
+        parameters = {
+            'N': sampling_parameters.get('number_of_points_in_domain', 100),
+            'sigma_ratio': sampling_parameters.get('sigma_ratio', (0.01, 1)),
+            'l': GP_parameters.get('l', 1.0),
+            'kappa': GP_parameters.get('kappa', 10.0),
+            'xi': GP_parameters.get('xi', 1e-6),
+            'sigma_0': physics_parameters.get('sigma_0', 0.0),
+            'sigma_f': physics_parameters.get('sigma_f', 1.0),
+            't_prod': physics_parameters.get('production_time', 0.0),
+            't_form': physics_parameters.get('formation_time', 1.0),
+        }
+        runtime_parameters = config.get('runtime_parameters', {})
+        parameters['sampler'] = runtime_parameters.get('sampler', 'cholesky')
+        parameters['rank'] = runtime_parameters.get('rank')
+        parameters['tolerance'] = runtime_parameters.get('tolerance')
+        parameters['precision'] = runtime_parameters.get('precision', 'float64')
+        parameters['factorization_memory'] = runtime_parameters.get('factorization_memory', 'dense')
+        parameters['block_size'] = runtime_parameters.get('factorization_block_size', 512)
+        parameters.update(kwargs)
+        if (parameters['N'] > MAX_IN_MEMORY_POINTS and parameters['sampler'] != 'circulant'
+                and parameters['factorization_memory'] == 'dense'):
+            raise ValueError("number_of_points_in_domain above %d requires factorization_memory 'blocked' or 'disk', "
+                             "or the circulant sampler" % MAX_IN_MEMORY_POINTS)
+        if sampling_parameters.get('output_sigma') is not None:
+            parameters['output_sigma'] = sampling_parameters['output_sigma']
+        constraint_parameters = config.get('constraint_parameters')
+        constraints = None
+        if constraint_parameters is not None:
+            constraints = {'sigma_points': constraint_parameters['sigma'], 'values': constraint_parameters['values'],
+                           'quantity': constraint_parameters.get('quantity', 'phi'),
+                           'noise': constraint_parameters.get('noise', 0.0)}
+        if sampling_parameters.get('grid', 'uniform') == 'adaptive':
+            if sampling_parameters.get('max_points_in_domain', 1000) > MAX_IN_MEMORY_POINTS:
+                raise ValueError("max_points_in_domain above %d is not supported, as adaptive grids are "
+                                 "factorized densely" % MAX_IN_MEMORY_POINTS)
+            # Integrate on an adaptive grid, and return samples on the requested uniform grid
+            from GaussianProcessCrossSectionGrid import adaptive_sigma_grid
+            parameters.setdefault('output_sigma', np.linspace(parameters['sigma_ratio'][0], parameters['sigma_ratio'][1], parameters['N']))
+            parameters['sigma'], grid_error = adaptive_sigma_grid(
+                parameters['sigma_ratio'], sampling_parameters.get('grid_tolerance', 1e-3),
+                max_points=sampling_parameters.get('max_points_in_domain', 1000),
+                A_range=sampling_parameters.get('A_range', (1, 1)), B_ratio_range=sampling_parameters.get('B_ratio_range', (0, 1)),
+                constraints=constraints, l=parameters['l'], kappa=parameters['kappa'], xi=parameters['xi'])
+        GP = cls(**parameters)
+        if sampling_parameters.get('grid', 'uniform') == 'adaptive':
+            # Estimated integration error of the adaptive grid, reported in status.yaml
+            GP.gridError = grid_error
+            GP.gridTolerance = sampling_parameters.get('grid_tolerance', 1e-3)
+            if grid_error > GP.gridTolerance:
+                warnings.warn("Adaptive grid of %d points reaches an error of %.2e, above grid_tolerance %.2e; raise max_points_in_domain"
+                              % (GP.N, grid_error, GP.gridTolerance))
+        if constraints is not None:
+            GP.setConstraints(**constraints)
+        return GP
+
+    def copyForConfig(self, config):
+        """Shallow copy sharing this factorization, with the physics parameters and constraints of config.
+
+        config must have the same factorization_key as the one this GP was
+        built from; physics parameters and constraints never require a new
+        factorization.
+        """
+        GP = copy.copy(self)
+        physics_parameters = config.get('physics_parameters', {})
+        GP.sigma_0 = physics_parameters.get('sigma_0', 0.0)
+        GP.sigma_f = physics_parameters.get('sigma_f', 1.0)
+        GP.t_prod = physics_parameters.get('production_time', 0.0)
+        GP.t_form = physics_parameters.get('formation_time', 1.0)
+        # Constraints only need a small solve against the shared factorization
+        constraint_parameters = config.get('constraint_parameters')
+        if constraint_parameters is not None:
+            GP.setConstraints(constraint_parameters['sigma'], constraint_parameters['values'],
+                              constraint_parameters.get('quantity', 'phi'), constraint_parameters.get('noise', 0.0))
+        else:
+            GP.clearConstraints()
+        return GP
+
+    def calculateCovarianceSigma(self, out=None, block_size=None):
+        """Calculate the covariance matrix for the cross-section.
+
+        With block_size, rows are computed block_size at a time into out
+        (allocated if not given), without N x N temporaries.
+        """
+        if block_size is None:
+            # Create a matrix with pairwise differences and apply the function element-wise
+            sigma_i = self.sigma[:, np.newaxis]
+            sigma_j = self.sigma[np.newaxis, :]
+            return self.kappa ** 2 * np.exp(-0.5 * ((sigma_i - sigma_j) / self.l) ** 2)
+        if out is None:
+            out = np.empty((self.N, self.N))
+        for start in range(0, self.N, block_size):
+            block = out[start:start + block_size]
+            np.subtract(self.sigma[start:start + block_size, np.newaxis], self.sigma[np.newaxis, :], out=block)
+            block /= self.l
+            np.square(block, out=block)
+            block *= -0.5
+            np.exp(block, out=block)
+            block *= self.kappa ** 2
+        return out
 
     def calculateCholeskyL(self):
         """Perform Cholesky decomposition on the covariance matrix."""
-        noiseMatrix = self.xi * np.eye(self.N)
-        return np.linalg.cholesky(self.SigmaMatrix + noiseMatrix)
+        # Reuse a previously computed factor if available
+        if self.cache is not None:
+            key = self.cache.key(self.sigma, self.l, self.kappa, self.xi, np.float64)
+            LMatrix = self.cache.load(key)
+            if LMatrix is not None:
+                return LMatrix
+        if self.factorization_memory == 'dense':
+            with stage('covariance', self.N ** 2):
+                self.SigmaMatrix = self.calculateCovarianceSigma()
+                noiseMatrix = self.xi * np.eye(self.N)
+            with stage('factorization', self.N):
+                LMatrix = np.linalg.cholesky(self.SigmaMatrix + noiseMatrix)
+            if self.cache is not None:
+                self.cache.store(key, LMatrix)
+            return LMatrix
+        # A single N x N buffer holds the covariance, then its factor
+        tmp_path = None
+        if self.factorization_memory == 'blocked':
+            LMatrix = np.empty((self.N, self.N))
+        elif self.cache is not None and 8 * self.N ** 2 <= self.cache.max_bytes:
+            # Factorized in the cache entry itself, so it is never copied
+            LMatrix, tmp_path = self.cache.open(key, (self.N, self.N))
+        else:
+            # A named file, so that worker processes can map it too (see
+            # share_factor), removed once the memmap is no longer used
+            handle, path = tempfile.mkstemp(suffix='.dat')
+            os.close(handle)
+            LMatrix = np.memmap(path, dtype=np.float64, mode='w+', shape=(self.N, self.N))
+            weakref.finalize(LMatrix, os.remove, path)
+        with stage('covariance', self.N ** 2):
+            self.calculateCovarianceSigma(LMatrix, self.block_size)
+            LMatrix[np.diag_indices(self.N)] += self.xi
+        with stage('factorization', self.N):
+            cholesky_in_place(LMatrix, self.block_size)
+        if tmp_path is not None:
+            return self.cache.commit(key, LMatrix, tmp_path)
+        if self.cache is not None and self.factorization_memory == 'blocked':
+            self.cache.store(key, LMatrix)
+        return LMatrix
+
+    def calculateCirculantEmbedding(self, max_embedding_factor=None):
+        """Eigenvalues of the smallest PSD circulant embedding of the covariance.
+
+        Only valid for a uniform grid. Returns sqrt(eigenvalues / M), or None
+        (with a warning) if no PSD embedding of at most max_embedding_factor * N
+        points is found (by default CIRCULANT_MAX_EMBEDDING, or
+        CIRCULANT_MAX_LARGE_EMBEDDING above MAX_IN_MEMORY_POINTS).
+        """
+        if max_embedding_factor is None:
+            max_embedding_factor = CIRCULANT_MAX_EMBEDDING if self.N <= MAX_IN_MEMORY_POINTS else CIRCULANT_MAX_LARGE_EMBEDDING
+        spacing = np.diff(self.sigma)
+        if self.N < 2 or not np.allclose(spacing, spacing[0]):
+            warnings.warn("Circulant embedding requires a uniform sigma grid; falling back to Cholesky.")
+            return None
+        # Smallest power of two that holds the 2(N-1) embedding
+        M = 1 << int(np.ceil(np.log2(max(2 * (self.N - 1), 2))))
+        while M <= max_embedding_factor * self.N:
+            with stage('factorization', M):
+                lags = np.minimum(np.arange(M), M - np.arange(M)) * spacing[0]
+                first_row = self.kappa ** 2 * np.exp(-0.5 * (lags / self.l) ** 2)
+                first_row[0] += self.xi
+                eigenvalues = np.fft.rfft(first_row).real
+            if eigenvalues.min() >= -1e-12 * eigenvalues.max():
+                eigenvalues = np.concatenate((eigenvalues, eigenvalues[1:M - M // 2][::-1]))
+                return np.sqrt(np.clip(eigenvalues, 0, None) / M)
+            M *= 2
+        warnings.warn("Circulant embedding is not positive semidefinite below %d points (l too long for the grid); falling back to Cholesky." % (max_embedding_factor * self.N))
+        return None
+
+    def calculateLowRankFactor(self):
+        """Truncated eigendecomposition of the covariance matrix.
+
+        Keeps self.rank modes, or the fewest modes whose discarded variance
+        fraction is below self.tolerance (1e-6 if neither is given). Sets
+        self.rank and self.discarded_variance and returns the (N, rank) factor.
+        """
+        with stage('covariance', self.N ** 2):
+            if self.factorization_memory == 'dense':
+                self.SigmaMatrix = self.calculateCovarianceSigma()
+                covariance = self.SigmaMatrix + self.xi * np.eye(self.N)
+            else:
+                # eigh needs the matrix in memory, but no more than one copy of it
+                covariance = self.calculateCovarianceSigma(block_size=self.block_size)
+                covariance[np.diag_indices(self.N)] += self.xi
+        with stage('factorization', self.N):
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        # Sort modes by decreasing variance
+        eigenvalues = np.clip(eigenvalues[::-1], 0, None)
+        eigenvectors = eigenvectors[:, ::-1]
+        total_variance = eigenvalues.sum()
+        # Fraction of the variance left out when keeping the first r modes
+        discarded = 1 - np.cumsum(eigenvalues) / total_variance
+        if self.rank is None:
+            tolerance = 1e-6 if self.tolerance is None else self.tolerance
+            self.rank = int(np.argmax(discarded <= tolerance)) + 1
+        self.rank = min(self.rank, self.N)
+        self.discarded_variance = max(float(discarded[self.rank - 1]), 0.0)
+        return eigenvectors[:, :self.rank] * np.sqrt(eigenvalues[:self.rank])
+
+    def setConstraints(self, sigma_points, values, quantity='phi', noise=0.0):
+        """Condition the samples on k known values of phi, dsigma/dt or time at given sigma.
+
+        Constraints hold for the written outputs: dsigma/dt values are
+        matched by the written dsigma/dt, phi values by the dsigma/dt they
+        give with each sample's A and B, A / (exp(phi) + B) (the written phi
+        is log(A / sigma - B), the same for every sample), and times by the
+        written time ratio, (t - t_prod) / (t_form - t_prod). Points are
+        snapped to the nearest grid point, and targets are read on the
+        nearest output point. The time ratio is 0 at the first grid point and
+        1 at the last by construction, so time constraints there must be
+        t_prod and t_form, and are dropped. noise is the variance of the
+        measurement noise of the values, in units of phi, log(dsigma/dt) or
+        time. See conditionNoise; the prior factor is reused as is, so setting
+        or changing constraints costs O(k N + k^3).
+        """
+        if quantity not in CONSTRAINT_QUANTITIES:
+            raise ValueError("Unknown constraint quantity '%s'" % quantity)
+        sigma_points = np.atleast_1d(np.asarray(sigma_points, dtype=np.float64))
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        if sigma_points.shape != values.shape:
+            raise ValueError("Constraints need one value per sigma point")
+        indices = np.abs(self.sigma[:, np.newaxis] - sigma_points).argmin(axis=0)
+        if len(np.unique(indices)) < len(indices):
+            raise ValueError("Constraints must fall on distinct grid points")
+        if quantity == 'time':
+            time_ratio = (values - self.t_prod) / (self.t_form - self.t_prod)
+            ends = (indices == 0) | (indices == self.N - 1)
+            if not np.allclose(time_ratio[ends], indices[ends] / (self.N - 1), rtol=0, atol=1e-9):
+                raise ValueError("Time constraints at the ends of the grid must be t_prod and t_form")
+            sigma_points, values, indices, time_ratio = sigma_points[~ends], values[~ends], indices[~ends], time_ratio[~ends]
+            order = np.argsort(indices)
+            if np.any(time_ratio <= 0) or np.any(time_ratio >= 1) or np.any(np.diff(time_ratio[order]) <= 0):
+                raise ValueError("Time constraints must lie between t_prod and t_form and increase with sigma")
+            if len(indices) == 0:
+                self.clearConstraints()
+                return
+        output_indices = np.abs(self.outputSigma[:, np.newaxis] - self.sigma[indices]).argmin(axis=0)
+        if len(np.unique(output_indices)) < len(output_indices):
+            raise ValueError("Constraints must fall on distinct output points")
+        # Samples are conditioned on their values at the constrained points
+        # and in the middle of the intervals between them and the grid ends,
+        # so that time can also be moved between intervals
+        bounds = np.concatenate(([0], np.sort(indices), [self.N - 1]))
+        conditioning_indices = np.unique(np.concatenate((indices, (bounds[:-1] + bounds[1:]) // 2)))
+        # Prior covariance between the grid and the conditioning points
+        K_cross = self.kappa ** 2 * np.exp(-0.5 * ((self.sigma[:, np.newaxis] - self.sigma[conditioning_indices]) / self.l) ** 2)
+        K_cross[conditioning_indices, np.arange(len(conditioning_indices))] += self.xi
+        self.constraintIndices = indices
+        self.constraintOutputIndices = output_indices
+        self.constraintValues = values
+        self.constraintQuantity = quantity
+        self.constraintNoise = noise
+        self.conditioningIndices = conditioning_indices
+        self.constraintGain = np.linalg.solve(K_cross[conditioning_indices], K_cross.T).T
+
+    def clearConstraints(self):
+        """Go back to unconditioned samples."""
+        self.constraintIndices = None
+
+    def constraintTargets(self, As, Bs, rng):
+        """Per-sample targets of the constraints, in log(dsigma/dt) or time ratio, shape (n_samples, k)."""
+        values = np.broadcast_to(self.constraintValues, (len(As), len(self.constraintValues)))
+        if self.constraintQuantity == 'dsigma_dt':
+            values = np.log(values)
+        if self.constraintNoise > 0:
+            values = values + rng.normal(scale=np.sqrt(self.constraintNoise), size=values.shape)
+        if self.constraintQuantity == 'phi':
+            return np.log(As / (np.exp(values) + Bs))
+        if self.constraintQuantity == 'time':
+            return (values - self.t_prod) / (self.t_form - self.t_prod)
+        return values
+
+    def conditionNoise(self, noise, As, Bs, rng=None):
+        """Turn prior samples (n_samples, N) into samples whose written outputs meet the constraints.
+
+        Written dsigma/dt and time ratios are normalized per sample, so they
+        are not linear in the GP draw f. Each sample is conditioned by
+        Matheron's rule on values y at the conditioning points J (see
+        setConstraints), f + K[:, J] K[J, J]^-1 (y - f[J]), and y is solved
+        for in float64 by Levenberg-Marquardt iterations on the written
+        outputs at the constrained points, with a finite difference
+        Jacobian. Each iteration integrates the samples once per
+        conditioning point, O(k N) per sample. Samples that do not meet
+        their targets (e.g. targets that need 1 / (dsigma/dt) below its
+        floor B / A) are reported with a warning.
+        """
+        rng = np.random if rng is None else rng
+        As = np.asarray(As, dtype=np.float64).reshape(-1, 1)
+        Bs = np.asarray(Bs, dtype=np.float64).reshape(-1, 1)
+        targets = self.constraintTargets(As, Bs, rng)
+        prior = noise.astype(np.float64)
+        n_samples, n_targets = targets.shape
+        n_points = len(self.conditioningIndices)
+
+        def residuals(rows, y):
+            conditioned = prior[rows] + (y - prior[rows][:, self.conditioningIndices]) @ self.constraintGain.T
+            _, dsigma_dt, time_ratio = self.integrateBatch(conditioned, As[rows], Bs[rows])
+            if self.constraintQuantity == 'time':
+                return time_ratio[:, self.constraintOutputIndices] - targets[rows]
+            return np.log(dsigma_dt[:, self.constraintOutputIndices]) - targets[rows]
+
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            y = prior[:, self.conditioningIndices].copy()
+            R = residuals(slice(None), y)
+            damping = np.full(n_samples, 1e-2)
+            for iteration in range(CONSTRAINT_ITERATIONS):
+                # Samples stop once converged, or stalled on targets they cannot reach
+                active = np.flatnonzero((np.abs(R) > CONSTRAINT_TOLERANCE).any(axis=1) & (damping < 1e12))
+                if len(active) == 0:
+                    break
+                jacobian = np.empty((len(active), n_targets, n_points))
+                for m in range(n_points):
+                    y_step = y[active].copy()
+                    y_step[:, m] += CONSTRAINT_STEP
+                    jacobian[:, :, m] = (residuals(active, y_step) - R[active]) / CONSTRAINT_STEP
+                # Damped normal equations; all unknowns are in units of phi
+                normal = jacobian.transpose(0, 2, 1) @ jacobian
+                diagonal = np.arange(n_points)
+                normal[:, diagonal, diagonal] += damping[active, np.newaxis]
+                gradient = jacobian.transpose(0, 2, 1) @ R[active, :, np.newaxis]
+                y_trial = y[active] - np.linalg.solve(normal, gradient)[:, :, 0]
+                R_trial = residuals(active, y_trial)
+                better = np.sum(R_trial ** 2, axis=1) < np.sum(R[active] ** 2, axis=1)
+                y[active[better]] = y_trial[better]
+                R[active[better]] = R_trial[better]
+                damping[active[better]] /= 10
+                damping[active[~better]] *= 10
+        failed = np.count_nonzero(~(np.abs(R) <= CONSTRAINT_TOLERANCE).all(axis=1))
+        if failed:
+            warnings.warn("%d of %d samples do not meet the constraints to %.0e" % (failed, n_samples, CONSTRAINT_TOLERANCE))
+        conditioned = prior + (y - prior[:, self.conditioningIndices]) @ self.constraintGain.T
+        return conditioned.astype(noise.dtype, copy=False)
+
+    def calculateNoise(self, n_samples, rng=None):
+        """Draw n_samples zero-mean GP samples on the grid, shape (n_samples, N).
+
+        Random numbers come from rng (a numpy.random.Generator) if given, and
+        from the global numpy random state otherwise.
+        """
+        rng = np.random if rng is None else rng
+        if self.sampler == 'circulant':
+            # Real and imaginary parts of each FFT give two independent samples
+            n_pairs = (n_samples + 1) // 2
+            M = self.circulantRoot.shape[0]
+            pairs_per_block = max(1, CIRCULANT_BLOCK_VALUES // M)
+            noise = np.empty((n_samples, self.N), dtype=self.dtype)
+            for start in range(0, n_pairs, pairs_per_block):
+                n_block = min(pairs_per_block, n_pairs - start)
+                Z = self.standardNormal(rng, (n_block, M)) + 1j * self.standardNormal(rng, (n_block, M))
+                Y = np.fft.fft(self.circulantRoot * Z, axis=1)[:, :self.N]
+                noise[2 * start:2 * (start + n_block)] = np.concatenate((Y.real, Y.imag))[:n_samples - 2 * start]
+            return noise
+        if self.sampler == 'lowrank':
+            return self.standardNormal(rng, (n_samples, self.rank)) @ self.lowRankFactor.T
+        # Rows of Z @ L^T are L @ z for each sample
+        return self.standardNormal(rng, (n_samples, self.N)) @ self.LMatrix.T
+
+    def standardNormal(self, rng, shape):
+        """Standard normal numbers of the sample type.
+
+        float64 draws are unchanged from rng.normal; a numpy Generator draws
+        float32 directly, other generators are cast.
+        """
+        if self.dtype == np.float32 and isinstance(rng, np.random.Generator):
+            return rng.standard_normal(size=shape, dtype=np.float32)
+        return rng.normal(size=shape).astype(self.dtype, copy=False)
+
+    def checkPrecision(self, n_samples=100, seed=0, A_range=(1, 1), B_ratio_range=(0, 1)):
+        """Largest errors of n_samples samples against a float64 reference GP.
+
+        The reference has the same grids, sampler and constraints and is fed
+        the same standard normals (cast to float32 for this GP), so the
+        errors come from the reduced precision alone: factor rounding,
+        sampling products, integration and rescaling. Returns the largest
+        absolute error of phi and time_ratio, the largest relative error of
+        dsigma_dt, and the number of values that overflowed or underflowed
+        (finite, nonzero values of the reference that are not here).
+        """
+        reference = GaussianProcessCrossSection(sigma=self.sigma, output_sigma=self.outputSigma, l=self.l,
+                                                kappa=self.kappa, xi=self.xi, sigma_0=self.sigma_0, sigma_f=self.sigma_f,
+                                                t_prod=self.t_prod, t_form=self.t_form, cache=self.cache,
+                                                sampler=self.sampler, rank=self.rank, tolerance=self.tolerance,
+                                                factorization_memory=self.factorization_memory, block_size=self.block_size)
+        if self.constraintIndices is not None:
+            reference.setConstraints(self.sigma[self.constraintIndices], self.constraintValues,
+                                     self.constraintQuantity, self.constraintNoise)
+        rng = np.random.default_rng(seed)
+        As = rng.uniform(A_range[0], A_range[1], size=n_samples)
+        Bs = rng.uniform(B_ratio_range[0], B_ratio_range[1], size=n_samples) * As
+        if self.sampler == 'circulant':
+            # Normals are drawn inside the FFT blocks; only the transform of
+            # the float64 noise is compared
+            reference_noise = reference.calculateNoise(n_samples, rng)
+            noise = reference_noise.astype(self.dtype)
+        else:
+            factor, reference_factor = ((self.lowRankFactor, reference.lowRankFactor) if self.sampler == 'lowrank'
+                                        else (self.LMatrix, reference.LMatrix))
+            Z = rng.normal(size=(n_samples, factor.shape[1]))
+            reference_noise = Z @ reference_factor.T
+            noise = Z.astype(self.dtype) @ factor.T
+        # Same constraint noise for both
+        results = [GP.calculateBatch(As, Bs, np.random.default_rng(seed + 1), noise=sample_noise)
+                   for GP, sample_noise in [(self, noise), (reference, reference_noise)]]
+        (phi, dsigma_dt, time_ratio), (reference_phi, reference_dsigma_dt, reference_time_ratio) = results
+        errors = {}
+        out_of_range = 0
+        for name, values, reference_values in [('phi', phi, reference_phi), ('dsigma_dt', dsigma_dt, reference_dsigma_dt),
+                                               ('time_ratio', time_ratio, reference_time_ratio)]:
+            reference_finite = np.isfinite(reference_values)
+            # Values that overflowed or underflowed are counted, not compared
+            in_range = np.isfinite(values) & ((values != 0) | (reference_values == 0))
+            out_of_range += int(np.sum(reference_finite & ~in_range))
+            both = in_range & reference_finite
+            error = np.abs(values[both] - reference_values[both])
+            if name == 'dsigma_dt':
+                error = error / np.abs(reference_values[both])
+            errors[name] = float(np.max(error, initial=0))
+        errors['out_of_range'] = out_of_range
+        return errors
 
     def calculatePhi(self, A, B):
         """Generate the GP sample for phi."""
         mu = 0*np.log((A / self.sigma) - B)
-        random_noise = np.dot(self.LMatrix, np.random.normal(size=self.N))
+        random_noise = self.calculateNoise(1)[0]
         self.phi = mu + random_noise
         return self.phi
 
@@ -69,4 +618,105 @@ class GaussianProcessCrossSection:
         self.dsigma_dt = np.array(self.dsigma_dt)
     
     def rescalePhi(self, A, B):
-        self.phi = np.log((A / self.sigma) - B)
\ No newline at end of file
+        self.phi = np.log((A / self.sigma) - B)
+
+    def calculateBatch(self, As, Bs, rng=None, noise=None):
+        """Generate a batch of samples, one per (A, B) pair.
+
+        Equivalent to running calculatePhi, calculateF, rescaleTime,
+        rescaleDsigmaDt and rescalePhi once per pair, but draws all the
+        noise at once and integrates/rescales along the last axis.
+        Returns phi, dsigma_dt and time_ratio as (n_samples, N) arrays
+        (on outputSigma if it differs from the domain).
+        The noise is drawn from rng as in calculateNoise, unless precomputed
+        noise of shape (n_samples, N) is given, and is then conditioned on
+        the constraints, if any.
+        """
+        As = np.asarray(As, dtype=self.dtype)[:, np.newaxis]
+        Bs = np.asarray(Bs, dtype=self.dtype)[:, np.newaxis]
+        n_samples = As.shape[0]
+        if noise is None:
+            with stage('sampling', n_samples):
+                noise = self.calculateNoise(n_samples, rng)
+        if self.constraintIndices is not None:
+            with stage('conditioning', n_samples):
+                noise = self.conditionNoise(noise, As, Bs, rng)
+        with stage('integration', n_samples):
+            return self.integrateBatch(noise, As, Bs)
+
+    def integrateBatch(self, noise, As, Bs):
+        """Integrate a batch of (conditioned) GP samples of shape (n_samples, N) into outputs.
+
+        Returns phi, dsigma_dt and time_ratio as in calculateBatch, in the
+        precision of noise. As and Bs have shape (n_samples, 1).
+        """
+        n_samples = noise.shape[0]
+        dtype = noise.dtype
+        sigma = self.sigma.astype(dtype, copy=False)
+        mu = 0*np.log((As / sigma) - Bs)
+        phi = mu + noise
+        with np.errstate(over='ignore'):
+            dsigma_dt = As / (np.exp(phi) + Bs)
+        # Cumulative integration of dsigma / (dsigma/dt). Times are rescaled
+        # below, so 1 / (dsigma/dt) = (exp(phi) + B) / A may be scaled per
+        # sample: dividing by exp(max(phi, 0)) keeps exp(phi) from overflowing
+        shift = np.maximum(np.max(phi, axis=1, keepdims=True), 0)
+        inverse_dsigma_dt = np.exp(phi[:, 1:] - shift) + Bs * np.exp(-shift)
+        Dsigma = np.diff(self.sigma).astype(dtype)
+        t = np.zeros((n_samples, self.N), dtype=dtype)
+        np.cumsum(Dsigma * inverse_dsigma_dt, axis=1, out=t[:, 1:])
+        # Rescale times to [0, 1] per sample
+        time_ratio_min = np.nanmin(t, axis=1, keepdims=True)
+        time_ratio_max = np.nanmax(t, axis=1, keepdims=True)
+        time_ratio = (t - time_ratio_min) / (time_ratio_max - time_ratio_min)
+        # Recover dsigma/dt from the rescaled times, Dsigma / diff(time_ratio),
+        # without differencing nearly equal times
+        with np.errstate(divide='ignore', over='ignore'):
+            dsigma_dt[:, 1:] = (time_ratio_max - time_ratio_min) / inverse_dsigma_dt
+        phi = np.log((As / sigma) - Bs)
+        if self.outputSigma is not self.sigma:
+            return self.resampleBatch(As, Bs, dsigma_dt, time_ratio)
+        return phi, dsigma_dt, time_ratio
+
+    def resampleBatch(self, As, Bs, dsigma_dt, time_ratio):
+        """Project a batch from the domain onto outputSigma.
+
+        Times are interpolated linearly (hence stay monotone), dsigma/dt is
+        recovered from the interpolated times as in calculateBatch, and phi
+        is evaluated on the output grid. Output points outside the domain
+        take the time ratio at the nearest end, and output intervals outside
+        it the dsigma/dt of the nearest domain interval.
+        """
+        dtype = dsigma_dt.dtype
+        j = np.clip(np.searchsorted(self.sigma, self.outputSigma), 1, self.N - 1)
+        weight = np.clip((self.outputSigma - self.sigma[j - 1]) / (self.sigma[j] - self.sigma[j - 1]), 0, 1).astype(dtype)
+        time_ratio = time_ratio[:, j - 1] + weight * (time_ratio[:, j] - time_ratio[:, j - 1])
+        output_dsigma_dt = np.empty_like(time_ratio)
+        output_dsigma_dt[:, 0] = dsigma_dt[:, j[0] - 1] + weight[0] * (dsigma_dt[:, j[0]] - dsigma_dt[:, j[0] - 1])
+        # Time increments of the output intervals, summed over the pieces
+        # they share with domain intervals instead of differencing times
+        points = np.unique(np.clip(np.concatenate((self.sigma, self.outputSigma)), max(self.sigma[0], self.outputSigma[0]),
+                                   min(self.sigma[-1], self.outputSigma[-1])))
+        midpoints = 0.5 * (points[1:] + points[:-1])
+        domain_interval = np.clip(np.searchsorted(self.sigma, midpoints), 1, self.N - 1)
+        output_interval = np.searchsorted(self.outputSigma, midpoints) - 1
+        with np.errstate(divide='ignore'):
+            increments = np.diff(points).astype(dtype) / dsigma_dt[:, domain_interval]
+        output_increments = np.zeros((len(time_ratio), len(self.outputSigma) - 1), dtype=dtype)
+        # Lengths of the output intervals inside the domain
+        lengths = np.diff(self.outputSigma)
+        partial = (self.outputSigma[:-1] < self.sigma[0]) | (self.outputSigma[1:] > self.sigma[-1])
+        lengths[partial] = 0
+        if len(points) > 1:
+            intervals, starts = np.unique(output_interval, return_index=True)
+            output_increments[:, intervals] = np.add.reduceat(increments, starts, axis=1)
+            inside_lengths = np.zeros_like(lengths)
+            inside_lengths[intervals] = np.add.reduceat(np.diff(points), starts)
+            lengths[partial] = inside_lengths[partial]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            output_dsigma_dt[:, 1:] = lengths.astype(dtype) / output_increments
+        # Output intervals outside the domain
+        output_dsigma_dt[:, 1:][:, self.outputSigma[1:] <= self.sigma[0]] = dsigma_dt[:, [1]]
+        output_dsigma_dt[:, 1:][:, self.outputSigma[:-1] >= self.sigma[-1]] = dsigma_dt[:, [-1]]
+        phi = np.log((As / self.outputSigma.astype(dtype)) - Bs)
+        return phi, output_dsigma_dt, time_ratio
\ No newline at end of file
@@ -0,0 +1,76 @@
+import numpy as np
+from GaussianProcessCrossSectionGenerator import GaussianProcessCrossSection
+
+def integration_error_indicators(GP, n_pilot=64, seed=0, A_range=(1, 1), B_ratio_range=(0, 1)):
+    """Estimated error of each grid interval on the time ratio, averaged over pilot samples.
+
+    Times are integrated as in calculateF, t[i] = t[i - 1] + Dsigma / (dsigma/dt)[i]
+    (rectangle rule). The difference with the trapezoid rule on the same
+    interval estimates its local error, expressed as a fraction of the
+    sample's total time, i.e. in units of the rescaled time ratio.
+    """
+    rng = np.random.default_rng(seed)
+    As = rng.uniform(A_range[0], A_range[1], size=(n_pilot, 1))
+    Bs = rng.uniform(B_ratio_range[0], B_ratio_range[1], size=(n_pilot, 1)) * As
+    noise = GP.calculateNoise(n_pilot, rng)
+    if GP.constraintIndices is not None:
+        noise = GP.conditionNoise(noise, As, Bs, rng)
+    inverse_dsigma_dt = (np.exp(noise) + Bs) / As
+    Dsigma = np.diff(GP.sigma)
+    rectangle = Dsigma * inverse_dsigma_dt[:, 1:]
+    trapezoid = 0.5 * Dsigma * (inverse_dsigma_dt[:, 1:] + inverse_dsigma_dt[:, :-1])
+    return np.nanmean(np.abs(trapezoid - rectangle) / rectangle.sum(axis=1, keepdims=True), axis=0)
+
+def equidistributed_grid(sigma, density, n_points, fixed_points=()):
+    """Grid of n_points over [sigma[0], sigma[-1]] with a local point density proportional to density.
+
+    density is piecewise constant on the intervals of sigma. fixed_points
+    (e.g. constraint locations) are added to the grid.
+    """
+    cumulative = np.concatenate(([0], np.cumsum(density * np.diff(sigma))))
+    grid = np.interp(np.linspace(0, cumulative[-1], n_points), cumulative, sigma)
+    grid[[0, -1]] = sigma[[0, -1]]
+    return np.unique(np.concatenate((grid, fixed_points)))
+
+def adaptive_sigma_grid(sigma_ratio=(0.01, 1), tolerance=1e-3, initial_points=33, max_points=1000,
+                        n_pilot=64, seed=0, A_range=(1, 1), B_ratio_range=(0, 1), constraints=None,
+                        iterations=3, **parameters):
+    """Non-uniform sigma grid on which the time ratio is integrated to about tolerance.
+
+    Pilot samples are drawn on the current grid (initially initial_points
+    uniform points) and the local error of each interval, e_i = c_i h_i^2,
+    is estimated with integration_error_indicators. The total error
+    sum c_i h_i^2 of M intervals is smallest when the points are
+    equidistributed, with a density proportional to c; the error is then
+    about L * integral(c) / M, which gives the number of points needed to
+    reach tolerance. The gain over a uniform grid with the same number of
+    points depends on how much c varies, and is small when the samples have
+    no systematic structure in sigma (stationary kernel, no constraints).
+    The grid is rebuilt this way a few times, so the estimates come from a
+    grid that resolves the samples.
+    parameters are passed on to GaussianProcessCrossSection (l, kappa,
+    xi, ...) and constraints, if any, to setConstraints; constraint points
+    are always kept on the grid, which has at most max_points points.
+    Returns the grid and its estimated error (above tolerance if
+    max_points were not enough).
+    """
+    parameters = dict(parameters, sampler='cholesky', cache=None)
+    fixed_points = np.asarray(constraints['sigma_points'], dtype=np.float64) if constraints is not None else np.array([])
+    sigma = np.unique(np.concatenate((np.linspace(sigma_ratio[0], sigma_ratio[1], initial_points), fixed_points)))
+    for iteration in range(iterations + 1):
+        GP = GaussianProcessCrossSection(sigma=sigma, **parameters)
+        if constraints is not None:
+            GP.setConstraints(**constraints)
+        errors = integration_error_indicators(GP, n_pilot, seed, A_range, B_ratio_range)
+        if iteration == iterations or errors.sum() <= tolerance and iteration > 0:
+            return sigma, float(errors.sum())
+        # Error coefficients, plus their mean: pilot estimates are noisy, and
+        # a density concentrated on them does worse than uniform on new samples
+        h = np.diff(sigma)
+        coefficients = errors / h ** 2
+        coefficients = coefficients + np.average(coefficients, weights=h)
+        integral = np.sum(coefficients * h)
+        # Number of intervals, leaving room for the end and constraint points
+        n_intervals = int(np.clip(np.ceil((sigma[-1] - sigma[0]) * integral / tolerance), initial_points,
+                                  max_points - 1 - len(fixed_points)))
+        sigma = equidistributed_grid(sigma, coefficients, n_intervals + 1, fixed_points)
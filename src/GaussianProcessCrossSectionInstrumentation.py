@@ -0,0 +1,165 @@
+import time
+import resource
+import threading
+
+# Stages recorded by the pipeline, in execution order
+STAGES = ['validation', 'covariance', 'factorization', 'sampling', 'conditioning', 'integration',
+          'summarizing', 'formatting', 'writing', 'plotting']
+
+# Active recorder, None while instrumentation is off
+_recorder = None
+
+class StageRecorder:
+    def __init__(self, profile_stage=None):
+        """Accumulated wall time, CPU time, peak RSS and item counts per stage.
+
+        If profile_stage is given, every entry into that stage is also run
+        under a single cProfile.Profile, dumped with dump_profile. Stages
+        can be recorded from several threads; only the main thread is profiled.
+        """
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.profile_stage = profile_stage
+        self.profiler = None
+        # Profile statistics received from other processes
+        self.merged_profiles = []
+        if profile_stage is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def record(self, name, wall_time, cpu_time, count=0, calls=1, peak_rss_MB=None):
+        peak_rss_MB = peak_rss_MB if peak_rss_MB is not None else peak_rss()
+        with self.lock:
+            entry = self.stages.setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_MB': 0.0,
+                                                  'count': 0, 'calls': 0})
+            entry['wall_time'] += wall_time
+            entry['cpu_time'] += cpu_time
+            entry['count'] += int(count)
+            entry['calls'] += calls
+            entry['peak_rss_MB'] = max(entry['peak_rss_MB'], peak_rss_MB)
+
+    def profile_stats(self):
+        """Raw cProfile statistics of the profiled stage (picklable), or None."""
+        if self.profiler is None:
+            return None
+        self.profiler.create_stats()
+        return self.profiler.stats
+
+    def report(self):
+        """Stages as a plain dict, in pipeline order, ready for status.yaml."""
+        order = {name: i for i, name in enumerate(STAGES)}
+        return {name: dict(self.stages[name]) for name in sorted(self.stages, key=lambda name: order.get(name, len(STAGES)))}
+
+class Stage:
+    __slots__ = ('recorder', 'name', 'count', 'wall_start', 'cpu_start', 'profiled')
+
+    def __init__(self, recorder, name, count):
+        self.recorder = recorder
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.profiled = (self.recorder.profiler is not None and self.name == self.recorder.profile_stage
+                         and threading.current_thread() is threading.main_thread())
+        if self.profiled:
+            self.recorder.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiled:
+            self.recorder.profiler.disable()
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = time.process_time() - self.cpu_start
+        self.recorder.record(self.name, wall_time, cpu_time, self.count)
+        return False
+
+class NullStage:
+    """Context manager doing nothing, returned while instrumentation is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+def peak_rss():
+    """Peak resident set size of the current process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def stage(name, count=0):
+    """Context manager timing a stage of count items (no-op when instrumentation is off)."""
+    if _recorder is None:
+        return NULL_STAGE
+    return Stage(_recorder, name, count)
+
+def record_stage(name, wall_time, cpu_time, count=0):
+    """Record a stage timed outside of stage(), e.g. before instrumentation was enabled."""
+    if _recorder is not None:
+        _recorder.record(name, wall_time, cpu_time, count)
+
+def merge_stage_report(report, profile_stats=None):
+    """Add a report from another process (e.g. a pool worker) to the active recorder.
+
+    Times and counts are summed and peak RSS is the largest of the processes.
+    Profile statistics of the other process are included in dump_profile.
+    """
+    if _recorder is None or report is None:
+        return
+    for name, entry in report.items():
+        _recorder.record(name, entry['wall_time'], entry['cpu_time'], entry['count'], entry['calls'], entry['peak_rss_MB'])
+    if profile_stats:
+        _recorder.merged_profiles.append(profile_stats)
+
+def instrumentation_enabled():
+    return _recorder is not None
+
+def instrumentation_settings():
+    """Arguments of enable_instrumentation reproducing the active recorder (None if off)."""
+    return None if _recorder is None else {'profile_stage': _recorder.profile_stage}
+
+def enable_instrumentation(profile_stage=None):
+    """Start recording stages in this process."""
+    global _recorder
+    _recorder = StageRecorder(profile_stage)
+    return _recorder
+
+def disable_instrumentation():
+    """Stop recording; return the report and the profile statistics (None if off)."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is None:
+        return None, None
+    return recorder.report(), recorder.profile_stats()
+
+def instrumentation_report():
+    return _recorder.report() if _recorder is not None else None
+
+def dump_profile(path):
+    """Write the cProfile statistics of the profiled stage to path (pstats format).
+
+    Returns path, or None if the stage was not profiled or never ran.
+    """
+    if _recorder is None or _recorder.profiler is None:
+        return None
+    import pstats
+    profiles = [raw_stats for raw_stats in [_recorder.profile_stats()] + _recorder.merged_profiles if raw_stats]
+    if not profiles:
+        return None
+    stats = pstats.Stats()
+    for raw_stats in profiles:
+        stats.add(RawProfile(raw_stats))
+    stats.dump_stats(path)
+    return path
+
+class RawProfile:
+    """Raw cProfile statistics in the form pstats.Stats accepts."""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
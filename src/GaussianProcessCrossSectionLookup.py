@@ -0,0 +1,73 @@
+import numpy as np
+from GaussianProcessCrossSectionTabulator import load_gp_cross_section
+
+class CrossSectionLookup:
+    def __init__(self, sigma, time_ratio, t_prod=0.0, t_form=1.0):
+        """Query index of sigma(t)/sigma_f and dsigma/dt for a tabulated ensemble.
+
+        All (n_samples, N) monotone time_ratio rows are stored in one sorted
+        array by shifting row k by k * offset, so a batch of (sample_id, t)
+        queries is answered with a single np.searchsorted, in O(log(n N))
+        per query, followed by linear (hence monotone) interpolation.
+        """
+        self.sigma = np.asarray(sigma, dtype=np.float64)
+        self.time_ratio = np.asarray(time_ratio, dtype=np.float64)
+        self.t_prod = t_prod
+        self.t_form = t_form
+        self.n_samples, self.N = self.time_ratio.shape
+        # Samples with undefined times (e.g. degenerate rescaling) return NaN
+        self.valid = np.all(np.isfinite(self.time_ratio), axis=1)
+        time_ratio = np.where(self.valid[:, np.newaxis], self.time_ratio, np.linspace(0, 1, self.N))
+        if np.any(np.diff(time_ratio, axis=1) < 0):
+            raise ValueError("time_ratio rows must be non-decreasing")
+        # Shift each row above the previous one
+        self.time_min = time_ratio[:, 0]
+        self.time_max = time_ratio[:, -1]
+        self.offset = self.time_max.max() - self.time_min.min() + 1.0
+        self.keys = (time_ratio + self.offset * np.arange(self.n_samples)[:, np.newaxis]).ravel()
+        # Slope of sigma(t) on each segment, as tabulated in dsigma_dt
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.slopes = np.diff(self.sigma) / np.diff(time_ratio, axis=1)
+
+    @classmethod
+    def from_gp_cross_section(cls, out_path, t_prod=0.0, t_form=1.0):
+        """Build the index from a binary ensemble written by the tabulator."""
+        data = load_gp_cross_section(out_path)
+        return cls(data['sigma'], data['time_ratio'], t_prod, t_form)
+
+    def evaluate(self, sample_ids, t):
+        """Evaluate sigma(t)/sigma_f and dsigma/dt for paired arrays of sample ids and times.
+
+        Times before production (after formation) give the first (last)
+        sigma and a vanishing dsigma/dt. dsigma/dt is in the tabulated units,
+        d(sigma/sigma_f) / d((t - t_prod)/(t_form - t_prod)).
+        """
+        sample_ids, t = np.broadcast_arrays(np.asarray(sample_ids, dtype=np.int64), np.asarray(t, dtype=np.float64))
+        time_ratio = (t - self.t_prod) / (self.t_form - self.t_prod)
+        inside = (time_ratio >= self.time_min[sample_ids]) & (time_ratio <= self.time_max[sample_ids])
+        time_ratio = np.clip(time_ratio, self.time_min[sample_ids], self.time_max[sample_ids])
+
+        # Locate the segment [j - 1, j] of each query within its own row
+        keys = time_ratio + self.offset * sample_ids
+        j = np.searchsorted(self.keys, keys, side='right') - sample_ids * self.N
+        j = np.clip(j, 1, self.N - 1)
+        right = sample_ids * self.N + j
+        width = self.keys[right] - self.keys[right - 1]
+        weight = np.divide(keys - self.keys[right - 1], width, out=np.ones_like(keys), where=width > 0)
+
+        sigma = self.sigma[j - 1] + weight * (self.sigma[j] - self.sigma[j - 1])
+        dsigma_dt = np.where(inside, self.slopes[sample_ids, j - 1], 0.0)
+        sigma[~self.valid[sample_ids]] = np.nan
+        dsigma_dt[~self.valid[sample_ids]] = np.nan
+        return sigma, dsigma_dt
+
+    def save(self, path, dtype=np.float32):
+        """Export the table as a compact .npz (times stored in dtype)."""
+        np.savez(path, sigma=self.sigma, time_ratio=self.time_ratio.astype(dtype),
+                 t_prod=self.t_prod, t_form=self.t_form)
+
+    @classmethod
+    def load(cls, path):
+        """Load a table written by save."""
+        with np.load(path) as table:
+            return cls(table['sigma'], table['time_ratio'], float(table['t_prod']), float(table['t_form']))
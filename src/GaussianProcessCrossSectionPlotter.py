@@ -1,19 +1,31 @@
-import matplotlib.pyplot as plt
-from matplotlib.ticker import AutoMinorLocator, MultipleLocator
-import matplotlib
 import os
 import sys
+import shutil
+import matplotlib
+
+# Render off-screen on display-less nodes; honour an explicitly chosen backend
+if 'MPLBACKEND' not in os.environ:
+    matplotlib.use('TkAgg' if os.environ.get('DISPLAY') else 'Agg')
+
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
+from matplotlib.ticker import AutoMinorLocator, MultipleLocator
 import numpy as np
 import pandas as pd
 from GaussianProcessCrossSectionGenerator import GaussianProcessCrossSection
+from GaussianProcessCrossSectionTabulator import load_gp_cross_section
+from PolynomialCrossSectionGenerator import PolynomialCrossSection
 
-matplotlib.use('TkAgg')
+# Use LaTeX only where it is installed
+USETEX = shutil.which('latex') is not None
 
 # Set formatting options
 plt.rcParams.update({
-    "text.usetex": True,
+    "text.usetex": USETEX,
     "font.family": "serif",
-    "font.serif": "Computer Modern Roman",
+    "font.serif": "Computer Modern Roman" if USETEX else "DejaVu Serif",
+    "mathtext.fontset": "cm",
     "text.latex.preamble": r'\usepackage{amsmath}',
     "axes.labelsize": 14,
     "font.size": 14,
@@ -21,12 +33,86 @@ plt.rcParams.update({
     "ytick.labelsize": 12,
 })
 
-def plot_gp_cross_section(out_path):
-    # Load tabulated data
-    df_phi_vs_dsigma_dt = pd.read_csv(os.path.join(out_path, 'phi_vs_dsigma_dt.dat'), sep='\s+')
-    df_sigma_vs_phi_and_dsigma_dt = pd.read_csv(os.path.join(out_path, 'sigma_vs_phi_and_dsigma_dt.dat'), sep='\s+')
-    df_time_ratio_vs_sigma = pd.read_csv(os.path.join(out_path, 'time_ratio_vs_sigma.dat'), sep='\s+')
-    
+# Above this many trajectories 'auto' mode draws densities instead of lines
+MAX_LINE_TRAJECTORIES = 10000
+# Line panels with more trajectories than this are rasterized in the saved files
+MAX_VECTOR_TRAJECTORIES = 1000
+# Densities are estimated from at most this many (evenly strided) trajectories
+MAX_DENSITY_TRAJECTORIES = 100000
+
+def label(expression):
+    """Axis label for a math expression, with or without LaTeX."""
+    if USETEX:
+        return r'${\displaystyle ' + expression + '}$'
+    return '$' + expression.replace(r'\text', r'\mathrm') + '$'
+
+def load_text_ensemble(out_path):
+    """Read the .dat tables into sigma (N,) and (n_samples, N) arrays."""
+    df_sigma_vs_phi_and_dsigma_dt = pd.read_csv(os.path.join(out_path, 'sigma_vs_phi_and_dsigma_dt.dat'), sep=r'\s+')
+    df_time_ratio_vs_sigma = pd.read_csv(os.path.join(out_path, 'time_ratio_vs_sigma.dat'), sep=r'\s+')
+    # Rows of each sample are contiguous, so reshaping gives one row per sample
+    n = df_sigma_vs_phi_and_dsigma_dt['index'].nunique()
+    sigma = df_sigma_vs_phi_and_dsigma_dt['sigma'].to_numpy().reshape(n, -1)[0]
+    phi = df_sigma_vs_phi_and_dsigma_dt['phi'].to_numpy().reshape(n, -1)
+    dsigma_dt = df_sigma_vs_phi_and_dsigma_dt['dsigma_dt'].to_numpy().reshape(n, -1)
+    time_ratio = df_time_ratio_vs_sigma['time_ratio'].to_numpy().reshape(n, -1)
+    return sigma, phi, dsigma_dt, time_ratio
+
+def load_binary_ensemble(out_path):
+    """Open the binary ensemble as sigma (N,) and memory-mapped (n_samples, N) arrays."""
+    data = load_gp_cross_section(out_path)
+    return data['sigma'], data['phi'], data['dsigma_dt'], data['time_ratio']
+
+def plot_lines(ax, x, y):
+    """Draw all trajectories of a panel as a single LineCollection."""
+    x, y = np.broadcast_arrays(x, y)
+    segments = np.stack((x, y), axis=-1)
+    segments[~np.isfinite(segments)] = np.nan
+    ax.add_collection(LineCollection(segments, colors='gray', alpha=0.1, rasterized=len(segments) > MAX_VECTOR_TRAJECTORIES))
+    ax.autoscale_view()
+
+def plot_density(ax, x, y, x_range=None, y_range=None, bins=200):
+    """Draw the 2D point density of all trajectories of a panel."""
+    x, y = np.broadcast_arrays(x, y)
+    x, y = x.ravel(), y.ravel()
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    x_range = x_range or tuple(np.percentile(x, [0.5, 99.5]))
+    y_range = y_range or tuple(np.percentile(y, [0.5, 99.5]))
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins, range=[x_range, y_range])
+    ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), cmap='Greys', norm=LogNorm(), rasterized=True)
+
+def plot_bands(ax, x, y, horizontal=False):
+    """Draw median and 50%/90% quantile bands of y on the shared grid x."""
+    q05, q25, q50, q75, q95 = np.nanpercentile(np.where(np.isfinite(y), y, np.nan), [5, 25, 50, 75, 95], axis=0)
+    fill = ax.fill_betweenx if horizontal else ax.fill_between
+    fill(x, q05, q95, color='gray', alpha=0.25, linewidth=0)
+    fill(x, q25, q75, color='gray', alpha=0.5, linewidth=0)
+    if horizontal:
+        ax.plot(q50, x, color='black', linewidth=1)
+    else:
+        ax.plot(x, q50, color='black', linewidth=1)
+
+def plot_gp_cross_section(out_path, output_format=None, mode='auto', alphas=None, polynomial=None):
+    """Plot a tabulated ensemble.
+
+    mode 'lines' draws every trajectory, 'density' draws 2D densities and
+    quantile bands, and 'auto' picks 'density' above MAX_LINE_TRAJECTORIES.
+    If alphas are given, the polynomial parametrizations of a
+    PolynomialCrossSection (on the ensemble's sigma grid by default) are
+    drawn on top.
+    """
+    # Load tabulated data, preferring the binary format when none is given
+    if output_format is None:
+        output_format = 'binary' if os.path.isdir(os.path.join(out_path, 'gp_cross_section')) else 'text'
+    if output_format == 'binary':
+        sigma, phi, dsigma_dt, time_ratio = load_binary_ensemble(out_path)
+    else:
+        sigma, phi, dsigma_dt, time_ratio = load_text_ensemble(out_path)
+    n = phi.shape[0]
+    if mode == 'auto':
+        mode = 'lines' if n <= MAX_LINE_TRAJECTORIES else 'density'
+
     # Create figures and axes
     fig1, ax1 = plt.subplots(1, 1, figsize=(3.04, 3.04), dpi=150, sharex=True)
     fig2, ax2 = plt.subplots(2, 1, figsize=(3.04, 5), dpi=150, sharex=True)
@@ -38,13 +124,13 @@ def plot_gp_cross_section(out_path):
     ax3.set_ylim(-0.05, 1.05)
 
     # Set axes labels
-    ax1.set_xlabel(r'${\displaystyle \phi(\sigma)}$')
-    ax1.set_ylabel(r'${\displaystyle \frac{d\sigma(t)}{dt}}$')
-    ax2[0].set_ylabel(r'${\displaystyle \phi(\sigma)}$')
-    ax2[1].set_ylabel(r'${\displaystyle \frac{d\sigma(t)}{dt}}$')
-    ax2[1].set_xlabel(r'${\displaystyle \sigma(t)/\sigma_f}$')
-    ax3.set_xlabel(r'${\displaystyle (t-t_\text{prod})/(t_\text{form}-t_\text{prod})}$')
-    ax3.set_ylabel(r'${\displaystyle \sigma(t)/\sigma_f}$')
+    ax1.set_xlabel(label(r'\phi(\sigma)'))
+    ax1.set_ylabel(label(r'\frac{d\sigma(t)}{dt}'))
+    ax2[0].set_ylabel(label(r'\phi(\sigma)'))
+    ax2[1].set_ylabel(label(r'\frac{d\sigma(t)}{dt}'))
+    ax2[1].set_xlabel(label(r'\sigma(t)/\sigma_f'))
+    ax3.set_xlabel(label(r'(t-t_\text{prod})/(t_\text{form}-t_\text{prod})'))
+    ax3.set_ylabel(label(r'\sigma(t)/\sigma_f'))
 
     # Set axes ticks
     ax1.tick_params(which='both', direction='in', labelsize=14, bottom=True, top=True, left=True, right=True)
@@ -58,27 +144,38 @@ def plot_gp_cross_section(out_path):
     ax3.xaxis.set_minor_locator(MultipleLocator(0.1))
     ax3.yaxis.set_minor_locator(AutoMinorLocator())
 
-    unique_indices = df_phi_vs_dsigma_dt['index'].unique()
-
-    for idx in unique_indices:
-        # Filter data for the current index
-        df_phi_vs_dsigma_dt_idx = df_phi_vs_dsigma_dt[df_phi_vs_dsigma_dt['index'] == idx]
-        df_sigma_vs_phi_and_dsigma_dt_idx = df_sigma_vs_phi_and_dsigma_dt[df_sigma_vs_phi_and_dsigma_dt['index'] == idx]
-        df_time_ratio_vs_sigma_idx = df_time_ratio_vs_sigma[df_time_ratio_vs_sigma['index'] == idx]
-            
+    if mode == 'lines':
         # Plot data
-        ax1.plot(df_phi_vs_dsigma_dt_idx['phi'], df_phi_vs_dsigma_dt_idx['dsigma_dt'], color='gray', alpha=0.1)
-        ax2[0].plot(df_sigma_vs_phi_and_dsigma_dt_idx['sigma'], df_sigma_vs_phi_and_dsigma_dt_idx['phi'], color='gray', alpha=0.1)
-        ax2[1].plot(df_sigma_vs_phi_and_dsigma_dt_idx['sigma'], df_sigma_vs_phi_and_dsigma_dt_idx['dsigma_dt'], color='gray', alpha=0.1)
-        ax3.plot(df_time_ratio_vs_sigma_idx['time_ratio'], df_time_ratio_vs_sigma_idx['sigma'], color='gray', alpha=0.1)
-        
-        # Plot polynomial parametrizations
-        # for alpha in [0.5, 1.0, 2.0, 3.0, 1000.0]:
-        #     ax2[1].plot(GP.sigma, GP.calculatePolynomialDsigmaDt_vs_sigma(alpha), label=r'$\alpha={}$'.format(alpha))
-        #     ax3.plot(t, GP.calculatePolynomialF_vs_t(t, alpha), label=r'$\alpha={}$'.format(alpha))
+        plot_lines(ax1, phi, dsigma_dt)
+        plot_lines(ax2[0], sigma, phi)
+        plot_lines(ax2[1], sigma, dsigma_dt)
+        plot_lines(ax3, time_ratio, sigma)
+    elif mode == 'density':
+        # Estimate densities from an evenly strided subset of the ensemble
+        stride = max(1, n // MAX_DENSITY_TRAJECTORIES)
+        phi = np.asarray(phi[::stride])
+        dsigma_dt = np.asarray(dsigma_dt[::stride])
+        time_ratio = np.asarray(time_ratio[::stride])
+        plot_density(ax1, phi, dsigma_dt, x_range=ax1.get_xlim(), y_range=ax2[1].get_ylim())
+        plot_bands(ax2[0], sigma, phi)
+        plot_bands(ax2[1], sigma, dsigma_dt)
+        plot_bands(ax3, sigma, time_ratio, horizontal=True)
+    else:
+        raise ValueError("Unknown plot mode '%s'" % mode)
+
+    # Plot polynomial parametrizations, all alphas evaluated in one call
+    if alphas is not None and len(alphas) > 0:
+        if polynomial is None:
+            polynomial = PolynomialCrossSection(N=len(sigma), sigma_ratio=(sigma[0], sigma[-1]))
+        t = np.linspace(polynomial.t_prod, polynomial.t_form, 200)
+        F_vs_t, _, dsigma_dt_vs_sigma = polynomial.calculateBatch(alphas, t)
+        time_ratio_grid = (t - polynomial.t_prod) / (polynomial.t_form - polynomial.t_prod)
+        for alpha, F, dsigma_dt_alpha in zip(alphas, F_vs_t, dsigma_dt_vs_sigma):
+            ax2[1].plot(polynomial.sigma, dsigma_dt_alpha, label=r'$\alpha={}$'.format(alpha))
+            ax3.plot(time_ratio_grid, F, label=r'$\alpha={}$'.format(alpha))
 
         # Add legends
-        # ax2[1].legend(fontsize=10, frameon=False, loc='upper right')
+        ax2[1].legend(fontsize=10, frameon=False, loc='upper right')
 
     fig1.tight_layout(pad=0.5, w_pad=0.0, h_pad=0.0)
     fig2.tight_layout(pad=0.5, w_pad=0.0, h_pad=0.0)
@@ -89,7 +186,11 @@ def plot_gp_cross_section(out_path):
     fig2.savefig(os.path.join(out_path, 'sigma_vs_phi_and_dsigma_dt.pdf'))
     fig3.savefig(os.path.join(out_path, 'time_ratio_vs_sigma.pdf'))
 
-    plt.show()
+    # Only show the figures when rendering to a display
+    if matplotlib.get_backend().lower() != 'agg':
+        plt.show()
+    for fig in [fig1, fig2, fig3]:
+        plt.close(fig)
 
 if __name__ == '__main__':
     plot_gp_cross_section(sys.argv[1])
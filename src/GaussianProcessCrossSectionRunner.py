@@ -0,0 +1,80 @@
+import os
+import time
+from GaussianProcessCrossSectionGenerator import GaussianProcessCrossSection
+from GaussianProcessCrossSectionCache import ResultCache, run_key, code_version
+from GaussianProcessCrossSectionInstrumentation import stage
+from PolynomialCrossSectionGenerator import PolynomialCrossSection
+
+def run_gp_cross_section(config, out_path, cache=None, result_cache_path=None, code_paths=(), GP=None, log=print):
+    """Run a validated config into out_path: a sweep, or tabulation and plots.
+
+    GP, if given, is used instead of building one from config (e.g. a copy
+    of a shared factorization, see copyForConfig). Outputs of identical runs
+    with a seed are reused from the result cache in result_cache_path (None
+    disables it); code_paths are the directories whose files version the
+    code. Messages are passed to log. Returns the entries of the run for
+    status.yaml (besides code and message).
+    """
+    runtime_parameters = config.get("runtime_parameters", {})
+    status = {}
+
+    #Outputs of identical runs (same validated config, seed and code) are reused;
+    #runs without a seed are not reproducible and are never cached
+    key = run_key(config, code_version(code_paths))
+    result_cache_size = runtime_parameters.get("result_cache_size_MB", 1024)
+    result_cache = None
+    if result_cache_path is not None and result_cache_size > 0 and runtime_parameters.get("seed") is not None:
+        result_cache = ResultCache(result_cache_path, int(result_cache_size * 1024 ** 2))
+    run_start = time.time()
+    result_cache_hit = result_cache is not None and result_cache.load(key, out_path)
+
+    if result_cache_hit:
+        log("Outputs of an identical run copied from the result cache")
+    elif "sweep_parameters" in config:
+        from GaussianProcessCrossSectionSweep import run_gp_cross_section_sweep
+        #Tabulate every point of the parameter grid, sharing factorizations and random numbers
+        sweep_report = run_gp_cross_section_sweep(config, out_path, cache)
+        log("Sweep of %(configs)d configs with %(factorizations)d factorization(s): %(wall_time).3f s (naive loop estimate: %(estimated_naive_time).3f s)" % sweep_report)
+    else:
+        CrossSection = GaussianProcessCrossSection.from_config(config, cache=cache) if GP is None else GP
+        if CrossSection.gridError is not None:
+            log("Adaptive grid of %d points, estimated error %.2e (grid_tolerance %.2e)" % (CrossSection.N, CrossSection.gridError, CrossSection.gridTolerance))
+            status["adaptive_grid"] = {"points": CrossSection.N, "error": CrossSection.gridError, "tolerance": CrossSection.gridTolerance}
+        if CrossSection.sampler == 'lowrank':
+            log("Low-rank sampler: rank %d, discarded variance fraction %.3e" % (CrossSection.rank, CrossSection.discarded_variance))
+        sampling_parameters = config.get("sampling_parameters", {})
+        number_of_samples = sampling_parameters.get("number_of_samples", 200)
+        A_range = sampling_parameters.get("A_range", [1, 1])
+        B_ratio_range = sampling_parameters.get("B_ratio_range", [0, 1])
+        output_format = runtime_parameters.get("output_format", "text")
+        chunk_size = runtime_parameters.get("chunk_size")
+        seed = runtime_parameters.get("seed")
+        workers = runtime_parameters.get("workers", 1)
+        time_points = runtime_parameters.get("statistics_time_points", 100)
+        sketch_size = runtime_parameters.get("sketch_size", 200)
+        #Compare reduced-precision samples against a float64 reference before tabulating
+        if runtime_parameters.get("precision", "float64") != "float64":
+            precision_check = CrossSection.checkPrecision(A_range=A_range, B_ratio_range=B_ratio_range)
+            log("%s precision check: phi %.2e, dsigma/dt %.2e (relative), time ratio %.2e, %d value(s) out of range" % (runtime_parameters["precision"], precision_check["phi"], precision_check["dsigma_dt"], precision_check["time_ratio"], precision_check["out_of_range"]))
+            status["precision_check"] = precision_check
+        #Completed chunks are checkpointed, and an interrupted run of the same config resumes from them
+        checkpoint_path = os.path.join(out_path, "checkpoint.pkl") if runtime_parameters.get("checkpoint", True) else None
+        from GaussianProcessCrossSectionTabulator import tabulate_gp_cross_section
+        resumed_samples = tabulate_gp_cross_section(CrossSection, out_path, number_of_samples, output_format, chunk_size, seed, workers, A_range, B_ratio_range, time_points, sketch_size, checkpoint_path, key,
+                                                    runtime_parameters.get("pipeline", False))
+        if resumed_samples > 0:
+            log("Resumed from a checkpoint after %d sample(s)" % resumed_samples)
+        plot_mode = runtime_parameters.get("plot_mode", "auto")
+        #Only summary tables are written in statistics mode, there are no trajectories to plot
+        if output_format == "statistics":
+            log("Ensemble statistics written to %s" % os.path.join(out_path, "gp_cross_section_statistics"))
+        elif plot_mode != "none":
+            with stage("plotting", number_of_samples):
+                from GaussianProcessCrossSectionPlotter import plot_gp_cross_section
+                #Optionally overlay the polynomial parametrizations for a few alphas
+                plot_gp_cross_section(out_path, output_format, plot_mode, runtime_parameters.get("polynomial_alphas"), PolynomialCrossSection.from_config(config))
+    if result_cache is not None:
+        if not result_cache_hit and result_cache.store(key, out_path, run_start, exclude=["status.yaml"]):
+            log("Outputs stored in the result cache")
+        status["result_cache"] = "hit" if result_cache_hit else "miss"
+    return status
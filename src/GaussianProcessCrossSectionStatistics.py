@@ -0,0 +1,212 @@
+import os
+import numpy as np
+from GaussianProcessCrossSectionInstrumentation import stage
+
+# Quantile levels of the summary tables (median and 1 and 2 sigma bands)
+QUANTILES = [0.025, 0.16, 0.5, 0.84, 0.975]
+
+# Quantities summarized by EnsembleStatistics: the three tabulated ones on the
+# sigma grid, and sigma(t) on a grid of time ratios
+SUMMARY_QUANTITIES = ['phi', 'dsigma_dt', 'time_ratio', 'sigma_vs_time_ratio']
+
+class RunningMoments:
+    def __init__(self, N):
+        """Running count, mean and sum of squared deviations of N columns.
+
+        Chunks are folded in with the pairwise (Chan et al.) form of
+        Welford's update, so partial results from different chunks or
+        processes merge exactly. Non-finite values are left out per column.
+        """
+        self.count = np.zeros(N)
+        self.mean = np.zeros(N)
+        self.M2 = np.zeros(N)
+
+    def update(self, values):
+        finite = np.isfinite(values)
+        count = finite.sum(axis=0)
+        mean = np.where(finite, values, 0).sum(axis=0) / np.maximum(count, 1)
+        M2 = (np.where(finite, values - mean, 0) ** 2).sum(axis=0)
+        self.combine(count, mean, M2)
+
+    def merge(self, other):
+        self.combine(other.count, other.mean, other.M2)
+
+    def combine(self, count, mean, M2):
+        total = self.count + count
+        delta = mean - self.mean
+        weight = np.divide(count, total, out=np.zeros_like(total), where=total > 0)
+        self.mean = self.mean + delta * weight
+        self.M2 = self.M2 + M2 + delta ** 2 * self.count * weight
+        self.count = total
+
+    def variance(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, self.M2 / (self.count - 1), np.nan)
+
+class QuantileSketch:
+    def __init__(self, N, k=200):
+        """Mergeable approximate quantiles of N columns (KLL-style compactors).
+
+        Level h holds items of weight 2^h, the same number for every column.
+        A level above its capacity is sorted column by column and every other
+        item is promoted to level h + 1. Capacities shrink geometrically
+        below the top level, so memory is O(k N) whatever the sample count,
+        and the rank error is O(1 / k).
+        """
+        self.N = N
+        self.k = k
+        self.levels = []
+        # Compaction parity per level, alternated to cancel the rounding bias
+        self.parities = []
+
+    def capacity(self, h):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - h))))
+
+    def update(self, values):
+        self.add(0, np.asarray(values, dtype=np.float64))
+        self.compress()
+
+    def merge(self, other):
+        for h, items in enumerate(other.levels):
+            self.add(h, items)
+        self.compress()
+
+    def add(self, h, items):
+        while len(self.levels) <= h:
+            self.levels.append(np.empty((0, self.N)))
+            self.parities.append(0)
+        self.levels[h] = np.concatenate((self.levels[h], items))
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.capacity(h):
+                # NaNs sort last, so they are compacted like any other value
+                items = np.sort(self.levels[h], axis=0)
+                # An odd item out stays at this level
+                leftover = len(items) % 2
+                self.levels[h] = items[len(items) - leftover:]
+                self.add(h + 1, items[self.parities[h]:len(items) - leftover:2])
+                self.parities[h] ^= 1
+            h += 1
+
+    def quantiles(self, levels):
+        """Quantiles of each column at the given levels, shape (len(levels), N)."""
+        if not self.levels:
+            return np.full((len(levels), self.N), np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** h) for h, items in enumerate(self.levels)])
+        order = np.argsort(values, axis=0)
+        values = np.take_along_axis(values, order, axis=0)
+        # Weighted ranks of the finite values of each column
+        ranks = np.cumsum(weights[order] * np.isfinite(values), axis=0)
+        total = ranks[-1]
+        result = np.empty((len(levels), self.N))
+        for i, level in enumerate(levels):
+            index = np.argmax(ranks >= level * total, axis=0)
+            result[i] = np.where(total > 0, values[index, np.arange(self.N)], np.nan)
+        return result
+
+class EnsembleStatistics:
+    def __init__(self, sigma, time_points=100, sketch_size=200):
+        """Streaming summary of a GP cross-section ensemble.
+
+        Keeps running moments and quantile sketches of phi, dsigma/dt and
+        time_ratio on the sigma grid, and of sigma(t) on time_points time
+        ratios in [0, 1]. Memory does not depend on the number of samples,
+        and statistics of disjoint chunks merge into those of their union.
+        """
+        self.sigma = np.asarray(sigma)
+        self.time_ratio_grid = np.linspace(0, 1, time_points)
+        self.sketch_size = sketch_size
+        self.n_samples = 0
+        widths = {'phi': len(self.sigma), 'dsigma_dt': len(self.sigma), 'time_ratio': len(self.sigma),
+                  'sigma_vs_time_ratio': time_points}
+        self.moments = {name: RunningMoments(width) for name, width in widths.items()}
+        self.sketches = {name: QuantileSketch(width, sketch_size) for name, width in widths.items()}
+
+    def update(self, chunk):
+        """Fold in a chunk of samples as generated by the tabulator."""
+        from GaussianProcessCrossSectionLookup import CrossSectionLookup
+        n = len(chunk['time_ratio'])
+        # sigma(t) of every sample on the common time grid
+        lookup = CrossSectionLookup(self.sigma, chunk['time_ratio'])
+        sample_ids = np.repeat(np.arange(n), len(self.time_ratio_grid))
+        sigma_vs_time_ratio, _ = lookup.evaluate(sample_ids, np.tile(self.time_ratio_grid, n))
+        values = {'phi': chunk['phi'], 'dsigma_dt': chunk['dsigma_dt'], 'time_ratio': chunk['time_ratio'],
+                  'sigma_vs_time_ratio': sigma_vs_time_ratio.reshape(n, -1)}
+        for name in SUMMARY_QUANTITIES:
+            self.moments[name].update(values[name])
+            self.sketches[name].update(values[name])
+        self.n_samples += n
+
+    def merge(self, other):
+        for name in SUMMARY_QUANTITIES:
+            self.moments[name].merge(other.moments[name])
+            self.sketches[name].merge(other.sketches[name])
+        self.n_samples += other.n_samples
+
+    def summary(self):
+        """Count, mean, standard deviation and QUANTILES of every quantity."""
+        summary = {'sigma': self.sigma, 'time_ratio_grid': self.time_ratio_grid, 'quantiles': np.array(QUANTILES),
+                   'n_samples': self.n_samples}
+        for name in SUMMARY_QUANTITIES:
+            summary[name + '_count'] = self.moments[name].count
+            summary[name + '_mean'] = self.moments[name].mean
+            summary[name + '_std'] = np.sqrt(self.moments[name].variance())
+            summary[name + '_quantiles'] = self.sketches[name].quantiles(QUANTILES)
+        return summary
+
+def summarize_gp_cross_section_chunk(GP, chunk, time_points=100, sketch_size=200):
+    """Statistics of a single chunk, to be merged into those of the ensemble."""
+    with stage('summarizing', len(chunk['A'])):
+        statistics = EnsembleStatistics(GP.outputSigma, time_points, sketch_size)
+        statistics.update(chunk)
+    return statistics
+
+class StatisticsEnsembleWriter:
+    def __init__(self, sigma, out_path, time_points=100, sketch_size=200, state=None):
+        """Merge chunk statistics and write the summary tables to out_path/gp_cross_section_statistics/.
+
+        The merged statistics are the checkpoint state.
+        """
+        import functools
+        self.statistics = EnsembleStatistics(sigma, time_points, sketch_size) if state is None else state
+        self.out_path = out_path
+        # Chunks are reduced to their statistics where they are generated
+        self.reduce_chunk = functools.partial(summarize_gp_cross_section_chunk, time_points=time_points,
+                                              sketch_size=sketch_size)
+        # Merged as a whole (see write_chunks_pipelined)
+        self.parts = ['statistics']
+
+    def write(self, start, statistics):
+        self.statistics.merge(statistics)
+
+    def write_part(self, name, start, statistics):
+        self.write(start, statistics)
+
+    def checkpoint(self):
+        return self.statistics
+
+    def close(self):
+        write_gp_cross_section_statistics(self.statistics.summary(), self.out_path)
+
+def write_gp_cross_section_statistics(summary, out_path):
+    """Write a summary as statistics.npz plus one whitespace-separated table per quantity."""
+    import pandas as pd
+    statistics_path = os.path.join(out_path, 'gp_cross_section_statistics')
+    os.makedirs(statistics_path, exist_ok=True)
+    np.savez(os.path.join(statistics_path, 'statistics.npz'), **summary)
+    for name in SUMMARY_QUANTITIES:
+        grid_name, grid = ('time_ratio', summary['time_ratio_grid']) if name == 'sigma_vs_time_ratio' else ('sigma', summary['sigma'])
+        columns = {grid_name: grid, 'count': summary[name + '_count'].astype(np.int64), 'mean': summary[name + '_mean'],
+                   'std': summary[name + '_std']}
+        for level, values in zip(QUANTILES, summary[name + '_quantiles']):
+            columns['q%g' % (100 * level)] = values
+        with open(os.path.join(statistics_path, name + '.dat'), 'w') as outfile:
+            pd.DataFrame(columns).to_string(outfile, index=False, float_format='%10.5f')
+
+def load_gp_cross_section_statistics(out_path):
+    """Load the summary written by StatisticsEnsembleWriter as a dict of arrays."""
+    with np.load(os.path.join(out_path, 'gp_cross_section_statistics', 'statistics.npz')) as summary:
+        return {name: summary[name] for name in summary.files}
@@ -0,0 +1,139 @@
+import os
+import copy
+import time
+import itertools
+import numpy as np
+import pandas as pd
+from GaussianProcessCrossSectionGenerator import GaussianProcessCrossSection
+from GaussianProcessCrossSectionTabulator import DEFAULT_CHUNK_SIZE, ENSEMBLE_QUANTITIES
+
+def expand_sweep_grid(config):
+    """List the sweep points of a config as dicts of l, kappa, xi, A_range and B_ratio_range.
+
+    Axes missing from sweep_parameters take their single value from the
+    GP_parameters and sampling_parameters sections.
+    """
+    GP_parameters = config.get('GP_parameters', {})
+    sampling_parameters = config.get('sampling_parameters', {})
+    sweep_parameters = config.get('sweep_parameters', {})
+    axes = {
+        'l': sweep_parameters.get('l', [GP_parameters.get('l', 1.0)]),
+        'kappa': sweep_parameters.get('kappa', [GP_parameters.get('kappa', 10.0)]),
+        'xi': sweep_parameters.get('xi', [GP_parameters.get('xi', 1e-6)]),
+        'A_range': sweep_parameters.get('A_range', [sampling_parameters.get('A_range', [1, 1])]),
+        'B_ratio_range': sweep_parameters.get('B_ratio_range', [sampling_parameters.get('B_ratio_range', [0, 1])]),
+    }
+    return [dict(zip(axes.keys(), values)) for values in itertools.product(*axes.values())]
+
+def run_gp_cross_section_sweep(config, out_path, cache=None):
+    """Tabulate every point of the config's sweep grid into out_path/sweep/.
+
+    Work is shared between sweep points:
+    - each distinct (l, xi) is factorized once, at the first kappa of the sweep;
+    - other kappas rescale the same noise by kappa / kappa_ref, which keeps the
+      kernel exact but scales the nugget to xi * (kappa / kappa_ref)^2
+      (recorded as effective_xi in the index);
+    - all points reuse the same random numbers (common random numbers), chunk
+      by chunk, so the point at kappa_ref reproduces a plain run with the same seed;
+    - with constraints, the conditioning gain K[:, I] K[I, I]^-1 is invariant
+      under the rescaling and is shared, and every point is conditioned
+      with the same constraint noise draws.
+    Returns a dict with the sweep wall time and an estimate of the naive
+    loop's wall time built from the measured factorization, sampling and
+    post-processing times.
+    """
+    sampling_parameters = config.get('sampling_parameters', {})
+    runtime_parameters = config.get('runtime_parameters', {})
+    n_samples = sampling_parameters.get('number_of_samples', 200)
+    chunk_size = runtime_parameters.get('chunk_size') or DEFAULT_CHUNK_SIZE
+    points = expand_sweep_grid(config)
+    kappa_ref = points[0]['kappa']
+    start_time = time.perf_counter()
+
+    # Group sweep points sharing a factorization
+    groups = {}
+    for config_id, point in enumerate(points):
+        groups.setdefault((point['l'], point['xi']), []).append(config_id)
+
+    sweep_path = os.path.join(out_path, 'sweep')
+    os.makedirs(sweep_path, exist_ok=True)
+    arrays = None
+    factor_time = {}
+    noise_time = {}
+    post_time = np.zeros(len(points))
+    chunk_starts = list(range(0, n_samples, chunk_size))
+    chunk_seeds = np.random.SeedSequence(runtime_parameters.get('seed')).spawn(len(chunk_starts))
+
+    for (l, xi), config_ids in groups.items():
+        tic = time.perf_counter()
+        GP = GaussianProcessCrossSection.from_config(config, l=l, kappa=kappa_ref, xi=xi, cache=cache)
+        factor_time[(l, xi)] = time.perf_counter() - tic
+        noise_time[(l, xi)] = 0.0
+        if arrays is None:
+            np.save(os.path.join(sweep_path, 'sigma.npy'), GP.outputSigma)
+            arrays = {name: np.lib.format.open_memmap(os.path.join(sweep_path, name + '.npy'), mode='w+',
+                                                      dtype=GP.dtype, shape=(len(points), n_samples))
+                      for name in ['A', 'B']}
+            arrays.update({name: np.lib.format.open_memmap(os.path.join(sweep_path, name + '.npy'), mode='w+',
+                                                           dtype=GP.dtype, shape=(len(points), n_samples, len(GP.outputSigma)))
+                           for name in ENSEMBLE_QUANTITIES})
+
+        for start, chunk_seed in zip(chunk_starts, chunk_seeds):
+            n = min(chunk_size, n_samples - start)
+            # Same draw order as generate_gp_cross_section_chunk
+            tic = time.perf_counter()
+            rng = np.random.default_rng(chunk_seed)
+            uniform_A = rng.random(n)
+            uniform_B = rng.random(n)
+            noise = GP.calculateNoise(n, rng)
+            noise_time[(l, xi)] += time.perf_counter() - tic
+
+            for config_id in config_ids:
+                tic = time.perf_counter()
+                point = points[config_id]
+                A_range, B_ratio_range = point['A_range'], point['B_ratio_range']
+                As = A_range[0] + (A_range[1] - A_range[0]) * uniform_A
+                Bs = (B_ratio_range[0] + (B_ratio_range[1] - B_ratio_range[0]) * uniform_B) * As
+                # Each point continues from the same generator state, as a plain run would
+                phi, dsigma_dt, time_ratio = GP.calculateBatch(As, Bs, copy.deepcopy(rng),
+                                                               noise=noise * (point['kappa'] / kappa_ref))
+                chunk = {'A': As, 'B': Bs, 'phi': phi, 'dsigma_dt': dsigma_dt, 'time_ratio': time_ratio}
+                for name, array in arrays.items():
+                    array[config_id, start:start + n] = chunk[name]
+                post_time[config_id] += time.perf_counter() - tic
+
+    for array in arrays.values():
+        array.flush()
+
+    # Index of the sweep points
+    df_index = pd.DataFrame({
+        'config': np.arange(len(points)),
+        'l': [point['l'] for point in points],
+        'kappa': [point['kappa'] for point in points],
+        'xi': [point['xi'] for point in points],
+        'effective_xi': [point['xi'] * (point['kappa'] / kappa_ref) ** 2 for point in points],
+        'A_min': [point['A_range'][0] for point in points],
+        'A_max': [point['A_range'][1] for point in points],
+        'B_ratio_min': [point['B_ratio_range'][0] for point in points],
+        'B_ratio_max': [point['B_ratio_range'][1] for point in points],
+    })
+    df_index.to_string(os.path.join(sweep_path, 'index.dat'), index=False)
+
+    wall_time = time.perf_counter() - start_time
+    # A naive loop factorizes and samples again for every sweep point
+    naive_time = sum(factor_time[(point['l'], point['xi'])] + noise_time[(point['l'], point['xi'])] + post_time[config_id]
+                     for config_id, point in enumerate(points))
+    return {"configs": len(points), "factorizations": len(groups),
+            "wall_time": round(wall_time, 6), "estimated_naive_time": round(float(naive_time), 6)}
+
+def load_gp_cross_section_sweep(out_path, mmap_mode='r'):
+    """Open a sweep written by run_gp_cross_section_sweep.
+
+    Returns the index DataFrame and a dict of arrays indexed as
+    [config, sample, grid point], memory-mapped by default.
+    """
+    sweep_path = os.path.join(out_path, 'sweep')
+    df_index = pd.read_csv(os.path.join(sweep_path, 'index.dat'), sep=r'\s+')
+    arrays = {name: np.load(os.path.join(sweep_path, name + '.npy'), mmap_mode=mmap_mode)
+              for name in ['sigma', 'A', 'B'] + ENSEMBLE_QUANTITIES}
+    return df_index, arrays
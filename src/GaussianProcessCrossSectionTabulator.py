@@ -1,41 +1,396 @@
 import os
+import queue
+import pickle
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
 import numpy as np
-import pandas as pd
 from GaussianProcessCrossSectionGenerator import GaussianProcessCrossSection
+from GaussianProcessCrossSectionInstrumentation import (stage, instrumentation_settings, enable_instrumentation,
+                                                        disable_instrumentation, merge_stage_report)
 
-def tabulate_gp_cross_section(GP, out_path):
-    n = 200  # Number of samples
-    As = np.random.uniform(1, 1, size=n)
-    Bs = np.random.rand(n) * As
-
-    # Create lists to store data
-    phi_vs_dsigma_dt_data = []
-    sigma_vs_phi_and_dsigma_dt_data = []
-    time_ratio_vs_sigma_data = []
-
-    # Tabulate GP samples
-    for idx, (A, B) in enumerate(zip(As, Bs)):
-        GP.calculatePhi(A, B)
-        GP.calculateDsigmaDt(A, B)
-        GP.calculateF(A, B)
-        GP.rescaleTime()
-        GP.rescaleDsigmaDt()
-        GP.rescalePhi(A, B)
-        
-        for i in range(GP.N):
-            phi_vs_dsigma_dt_data.append([idx, GP.phi[i], GP.dsigma_dt[i]])
-            sigma_vs_phi_and_dsigma_dt_data.append([idx, GP.sigma[i], GP.phi[i], GP.dsigma_dt[i]])
-            time_ratio_vs_sigma_data.append([idx, GP.time_ratio[i], GP.sigma[i]])
-
-    # Create DataFrames
-    df_phi_vs_dsigma_dt = pd.DataFrame(phi_vs_dsigma_dt_data, columns=['index', 'phi', 'dsigma_dt'])
-    df_sigma_vs_phi_and_dsigma_dt = pd.DataFrame(sigma_vs_phi_and_dsigma_dt_data, columns=['index', 'sigma', 'phi', 'dsigma_dt'])
-    df_time_ratio_vs_sigma = pd.DataFrame(time_ratio_vs_sigma_data, columns=['index', 'time_ratio', 'sigma'])
-
-    # Write DataFrames to text files
-    df_phi_vs_dsigma_dt.to_string(os.path.join(out_path, 'phi_vs_dsigma_dt.dat'), index=False, float_format='%10.5f')
-    df_sigma_vs_phi_and_dsigma_dt.to_string(os.path.join(out_path, 'sigma_vs_phi_and_dsigma_dt.dat'), index=False, float_format='%10.5f')
-    df_time_ratio_vs_sigma.to_string(os.path.join(out_path, 'time_ratio_vs_sigma.dat'), index=False, float_format='%10.5f')
+# Quantities stored by the binary format, one (n_samples, N) array each
+ENSEMBLE_QUANTITIES = ['phi', 'dsigma_dt', 'time_ratio']
+
+# Default number of samples per chunk; fixed so that the samples drawn for a
+# given seed do not depend on the number of workers
+DEFAULT_CHUNK_SIZE = 10000
+
+# Columns of the tables written by the text format
+TEXT_TABLES = {'phi_vs_dsigma_dt': ['index', 'phi', 'dsigma_dt'],
+               'sigma_vs_phi_and_dsigma_dt': ['index', 'sigma', 'phi', 'dsigma_dt'],
+               'time_ratio_vs_sigma': ['index', 'time_ratio', 'sigma']}
+
+# Chunks queued for each writer thread of a pipelined run (double buffering)
+PIPELINE_QUEUE_SIZE = 2
+
+# GP used by the pool workers, attached to the shared Cholesky factor
+_worker_GP = None
+_worker_shm = None
+_worker_instrumentation = None
+_worker_reduce_chunk = None
+
+def tabulate_gp_cross_section(GP, out_path, n_samples=200, output_format='text', chunk_size=None,
+                              seed=None, workers=1, A_range=(1, 1), B_ratio_range=(0, 1),
+                              time_points=100, sketch_size=200, checkpoint_path=None, run_key=None,
+                              pipeline=False, start_method=None):
+    """Generate n_samples GP samples and write them to out_path.
+
+    Samples are generated and written chunk_size at a time, so peak memory
+    is set by the chunk size and not by n_samples. Each chunk draws from its
+    own numpy.random.Generator spawned from SeedSequence(seed), so for a
+    given seed the output is identical whatever the number of workers.
+    A is drawn uniformly from A_range and B / A from B_ratio_range.
+    The 'statistics' format keeps no trajectories: each chunk is reduced to
+    its moments and quantile sketches (with sigma(t) on time_points time
+    ratios) where it is generated, and only the merged summary is written.
+    If checkpoint_path is given, the number of written chunks, the root seed
+    and the writer state are saved there after every chunk. A checkpoint of
+    the same run (run_key, sample count, chunk size and format) found there
+    is resumed from its last chunk, with the same samples as an
+    uninterrupted run; the checkpoint is removed once the output is complete.
+    With pipeline, chunks are written by threads while the next ones are
+    generated (see write_chunks_pipelined); the output is the same.
+    start_method is the multiprocessing start method of the worker pool
+    (the platform default if None); multithreaded callers should not fork.
+    Returns the number of samples taken from a checkpoint.
+    """
+    chunk_size = DEFAULT_CHUNK_SIZE if chunk_size is None else chunk_size
+    run = {'run_key': run_key, 'n_samples': n_samples, 'chunk_size': chunk_size, 'output_format': output_format}
+    checkpoint = load_checkpoint(checkpoint_path, run) if checkpoint_path is not None else None
+    # The root entropy is saved, so runs without a seed resume with the same chunk seeds
+    root_seed = np.random.SeedSequence(seed if checkpoint is None else checkpoint['entropy'])
+    chunk_starts = list(range(0, n_samples, chunk_size))
+    chunk_seeds = root_seed.spawn(len(chunk_starts))
+    tasks = [(min(chunk_size, n_samples - start), chunk_seed, A_range, B_ratio_range)
+             for start, chunk_seed in zip(chunk_starts, chunk_seeds)]
+    first_chunk = 0 if checkpoint is None else checkpoint['chunks']
+
+    writer = open_gp_cross_section_writer(GP.outputSigma, n_samples, out_path, output_format, time_points, sketch_size,
+                                          GP.dtype, None if checkpoint is None else checkpoint['writer'])
+    reduce_chunk = getattr(writer, 'reduce_chunk', None)
+    remaining_tasks = tasks[first_chunk:]
+    if workers > 1 and len(remaining_tasks) > 1:
+        chunks = generate_chunks_in_parallel(GP, remaining_tasks, workers, reduce_chunk, start_method)
+    else:
+        chunks = (generate_gp_cross_section_chunk(GP, *task) for task in remaining_tasks)
+        if reduce_chunk is not None:
+            chunks = (reduce_chunk(GP, chunk) for chunk in chunks)
+    # Text output is dominated by formatting the numbers, binary output by the copy to disk
+    write_stage = 'formatting' if output_format == 'text' else 'writing'
+
+    def save(i):
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, dict(run, entropy=root_seed.entropy, chunks=i + 1,
+                                                  writer=writer.checkpoint()))
+
+    items = zip(range(first_chunk, len(tasks)), chunk_starts[first_chunk:], (task[0] for task in remaining_tasks), chunks)
+    if pipeline:
+        write_chunks_pipelined(writer, items, write_stage, save)
+    else:
+        for i, start, n, chunk in items:
+            with stage(write_stage, n):
+                writer.write(start, chunk)
+                save(i)
+    with stage(write_stage):
+        writer.close()
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return sum(task[0] for task in tasks[:first_chunk])
+
+def write_chunks_pipelined(writer, items, stage_name='writing', on_chunk=None):
+    """Write (i, start, n, chunk) items with one thread per part of writer.
+
+    The calling thread keeps producing items while earlier chunks are
+    formatted and written; each part has a queue of PIPELINE_QUEUE_SIZE
+    chunks, so production blocks when the slowest part falls behind. The
+    parts wait for each other after every chunk, and on_chunk(i) is then
+    called while the writer is idle (e.g. to checkpoint it). Stage times of
+    parts written concurrently add up.
+    """
+    parts = writer.parts
+    queues = [queue.Queue(PIPELINE_QUEUE_SIZE) for _ in parts]
+    errors = []
+    # Index of the chunk the parts are writing, for on_chunk
+    current = [None]
+    barrier = threading.Barrier(len(parts), action=None if on_chunk is None else lambda: on_chunk(current[0]))
+
+    def write_part(part, part_queue):
+        while True:
+            item = part_queue.get()
+            if item is None:
+                return
+            # After a failure, chunks are only drained so that the producer never blocks
+            if errors:
+                continue
+            i, start, n, chunk = item
+            current[0] = i
+            try:
+                with stage(stage_name, n if part == parts[0] else 0):
+                    writer.write_part(part, start, chunk)
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            except Exception as e:
+                errors.append(e)
+                barrier.abort()
+
+    threads = [threading.Thread(target=write_part, args=(part, part_queue), daemon=True)
+               for part, part_queue in zip(parts, queues)]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in items:
+            if errors:
+                break
+            for part_queue in queues:
+                part_queue.put(item)
+    finally:
+        for part_queue in queues:
+            part_queue.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+def load_checkpoint(checkpoint_path, run):
+    """Checkpoint saved at checkpoint_path for the same run, or None."""
+    try:
+        with open(checkpoint_path, 'rb') as infile:
+            checkpoint = pickle.load(infile)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    if any(checkpoint.get(name) != value for name, value in run.items()):
+        return None
+    return checkpoint
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """Replace the checkpoint atomically, so an interruption leaves the previous one."""
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'wb') as outfile:
+        pickle.dump(checkpoint, outfile)
+    os.replace(tmp_path, checkpoint_path)
+
+def generate_gp_cross_section_chunk(GP, n, seed, A_range=(1, 1), B_ratio_range=(0, 1)):
+    """Generate one chunk of n samples from its own random generator."""
+    rng = np.random.default_rng(seed)
+    As = rng.uniform(A_range[0], A_range[1], size=n)
+    Bs = rng.uniform(B_ratio_range[0], B_ratio_range[1], size=n) * As
+
+    # Tabulate GP samples in a single batch
+    phi, dsigma_dt, time_ratio = GP.calculateBatch(As, Bs, rng)
+    return {'A': As, 'B': Bs, 'phi': phi, 'dsigma_dt': dsigma_dt, 'time_ratio': time_ratio}
+
+def generate_chunks_in_parallel(GP, tasks, workers, reduce_chunk=None, start_method=None):
+    """Yield generated chunks in order, spreading tasks over a process pool.
+
+    The Cholesky factor is placed in shared memory once (see share_factor)
+    instead of being pickled for every worker, and the covariance matrix is
+    left out. At most two chunks per worker are in flight.
+    If given, reduce_chunk(GP, chunk) runs in the workers and its (picklable)
+    result is yielded instead of the chunk.
+    With instrumentation on, the stages timed in the workers are added to
+    the report of this process. Workers are started with start_method
+    (see multiprocessing.get_context).
+    """
+    # Sampling never uses the covariance matrix, it is not sent to the workers
+    SigmaMatrix, GP.SigmaMatrix = GP.SigmaMatrix, None
+    LMatrix, factor, shm = share_factor(GP)
+    try:
+        initargs = (GP, factor, instrumentation_settings(), reduce_chunk)
+        with multiprocessing.get_context(start_method).Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_generate_chunk_in_worker, task))
+                if len(pending) >= 2 * workers:
+                    yield _merge_worker_stages(pending.popleft().get())
+            while pending:
+                yield _merge_worker_stages(pending.popleft().get())
+    finally:
+        GP.LMatrix = LMatrix
+        GP.SigmaMatrix = SigmaMatrix
+        release_factor(shm)
+
+def share_factor(GP):
+    """Hand the Cholesky factor of GP to other processes, which attach_factor to it.
+
+    A factor memory-mapped from a file (factorization_memory 'disk' or the
+    Cholesky cache) is mapped by the other processes too; any other factor
+    is copied to shared memory once. Returns the factor taken from GP
+    (restore it with GP.LMatrix = factor), a picklable handle and the
+    shared block to release_factor once the other processes are done; the
+    last two are None without a factor, the block also for mapped files.
+    """
+    LMatrix = GP.LMatrix
+    if LMatrix is None:
+        return None, None, None
+    GP.LMatrix = None
+    if isinstance(LMatrix, np.memmap) and LMatrix.filename is not None and os.path.exists(LMatrix.filename):
+        return LMatrix, {'file': LMatrix.filename, 'offset': LMatrix.offset, 'shape': LMatrix.shape, 'dtype': LMatrix.dtype}, None
+    shm = shared_memory.SharedMemory(create=True, size=LMatrix.nbytes)
+    np.ndarray(LMatrix.shape, dtype=LMatrix.dtype, buffer=shm.buf)[:] = LMatrix
+    return LMatrix, {'shm': shm.name, 'shape': LMatrix.shape, 'dtype': LMatrix.dtype}, shm
+
+def attach_factor(GP, factor):
+    """Point GP at a factor shared by share_factor; returns the block to keep open while GP is used (if any)."""
+    if factor is None:
+        return None
+    if 'file' in factor:
+        GP.LMatrix = np.memmap(factor['file'], dtype=factor['dtype'], mode='r', offset=factor['offset'], shape=factor['shape'])
+        return None
+    shm = shared_memory.SharedMemory(name=factor['shm'])
+    GP.LMatrix = np.ndarray(factor['shape'], dtype=factor['dtype'], buffer=shm.buf)
+    return shm
+
+def release_factor(shm):
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+def _init_worker(GP, factor, instrumentation=None, reduce_chunk=None):
+    global _worker_GP, _worker_shm, _worker_instrumentation, _worker_reduce_chunk
+    _worker_shm = attach_factor(GP, factor)
+    _worker_GP = GP
+    _worker_instrumentation = instrumentation
+    _worker_reduce_chunk = reduce_chunk
+
+def _generate_chunk_in_worker(*task):
+    """Generate (and reduce) a chunk; return it with the worker's stage report and profile."""
+    if _worker_instrumentation is not None:
+        enable_instrumentation(**_worker_instrumentation)
+    chunk = generate_gp_cross_section_chunk(_worker_GP, *task)
+    if _worker_reduce_chunk is not None:
+        chunk = _worker_reduce_chunk(_worker_GP, chunk)
+    return (chunk,) + disable_instrumentation()
+
+def _merge_worker_stages(result):
+    chunk, report, profile_stats = result
+    merge_stage_report(report, profile_stats)
+    return chunk
+
+def open_gp_cross_section_writer(sigma, n_samples, out_path, output_format, time_points=100, sketch_size=200,
+                                 dtype=np.float64, state=None):
+    """Return a chunk writer for the requested output format (binary arrays are stored as dtype).
+
+    Writers save their progress with checkpoint(); a writer opened with
+    that state continues the output instead of starting it over.
+    """
+    if output_format == 'binary':
+        return BinaryEnsembleWriter(sigma, n_samples, out_path, dtype, state)
+    elif output_format == 'text':
+        return TextEnsembleWriter(sigma, out_path, state)
+    elif output_format == 'statistics':
+        from GaussianProcessCrossSectionStatistics import StatisticsEnsembleWriter
+        return StatisticsEnsembleWriter(sigma, out_path, time_points, sketch_size, state)
+    raise ValueError("Unknown output format '%s'" % output_format)
+
+class BinaryEnsembleWriter:
+    def __init__(self, sigma, n_samples, out_path, dtype=np.float64, state=None):
+        """Write an ensemble as one .npy file per quantity in out_path/gp_cross_section/."""
+        ensemble_path = os.path.join(out_path, 'gp_cross_section')
+        os.makedirs(ensemble_path, exist_ok=True)
+        np.save(os.path.join(ensemble_path, 'sigma.npy'), sigma)
+        # Preallocate the arrays on disk and fill them chunk by chunk (resumed
+        # runs reopen the arrays written so far)
+        mode = 'w+' if state is None else 'r+'
+        self.arrays = {}
+        for name in ['A', 'B']:
+            self.arrays[name] = np.lib.format.open_memmap(os.path.join(ensemble_path, name + '.npy'), mode=mode,
+                                                          dtype=dtype, shape=(n_samples,))
+        for name in ENSEMBLE_QUANTITIES:
+            self.arrays[name] = np.lib.format.open_memmap(os.path.join(ensemble_path, name + '.npy'), mode=mode,
+                                                          dtype=dtype, shape=(n_samples, len(sigma)))
+
+        # Arrays can be written independently (see write_chunks_pipelined)
+        self.parts = list(self.arrays)
+
+    def write(self, start, chunk):
+        for name in self.parts:
+            self.write_part(name, start, chunk)
+
+    def write_part(self, name, start, chunk):
+        self.arrays[name][start:start + len(chunk[name])] = chunk[name]
+
+    def checkpoint(self):
+        for array in self.arrays.values():
+            array.flush()
+        return {}
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+
+class TextEnsembleWriter:
+    def __init__(self, sigma, out_path, state=None):
+        """Write an ensemble as the three whitespace-separated .dat tables.
+
+        A resumed writer cuts each table back to its size in state, dropping
+        rows written after the checkpoint.
+        """
+        self.sigma = sigma
+        self.files = {}
+        # Tables can be written independently (see write_chunks_pipelined)
+        self.parts = list(TEXT_TABLES)
+        for name in self.parts:
+            if state is None:
+                self.files[name] = open(os.path.join(out_path, name + '.dat'), 'w')
+            else:
+                self.files[name] = open(os.path.join(out_path, name + '.dat'), 'r+')
+                self.files[name].truncate(state[name])
+                self.files[name].seek(state[name])
+
+    def write(self, start, chunk):
+        for name in self.parts:
+            self.write_part(name, start, chunk)
+
+    def write_part(self, name, start, chunk):
+        """Append a chunk to one of the tables."""
+        # pandas is only needed (and imported) for text output
+        import pandas as pd
+        n, N = chunk['phi'].shape
+        columns = {}
+        for column in TEXT_TABLES[name]:
+            if column == 'index':
+                columns[column] = np.repeat(np.arange(start, start + n), N)
+            elif column == 'sigma':
+                columns[column] = np.tile(self.sigma, n)
+            else:
+                columns[column] = np.ravel(chunk[column])
+
+        # Append the table, with the header only before the first chunk
+        outfile = self.files[name]
+        if outfile.tell() > 0:
+            outfile.write('\n')
+        pd.DataFrame(columns).to_string(outfile, index=False, header=outfile.tell() == 0, float_format='%10.5f')
+
+    def checkpoint(self):
+        for outfile in self.files.values():
+            outfile.flush()
+        return {name: outfile.tell() for name, outfile in self.files.items()}
+
+    def close(self):
+        for outfile in self.files.values():
+            outfile.close()
+
+def load_gp_cross_section(out_path, mmap_mode='r'):
+    """Open an ensemble written by BinaryEnsembleWriter.
+
+    Arrays are memory-mapped by default, so slicing e.g. data['phi'][i:j]
+    only reads the requested samples from disk.
+    """
+    ensemble_path = os.path.join(out_path, 'gp_cross_section')
+    return {name: np.load(os.path.join(ensemble_path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in ['sigma', 'A', 'B'] + ENSEMBLE_QUANTITIES}
+
+def export_gp_cross_section_text(data, out_path, chunk_size=10000):
+    """Write a loaded ensemble as the three .dat tables, chunk_size samples at a time."""
+    writer = TextEnsembleWriter(data['sigma'], out_path)
+    n_samples = data['phi'].shape[0]
+    for start in range(0, n_samples, chunk_size):
+        writer.write(start, {name: np.asarray(data[name][start:start + chunk_size]) for name in ENSEMBLE_QUANTITIES})
+    writer.close()
 
 if __name__ == '__main__':
     GP = GaussianProcessCrossSection()
@@ -1,13 +1,26 @@
 import numpy as np
 
 class PolynomialCrossSection:
-    def __init__(self):
-        self.sigma = np.linspace(0.01, 1, self.N)  # Cross section domain
+    def __init__(self, N=100, sigma_ratio=(0.01, 1), sigma_0=0.0, sigma_f=1.0, t_prod=0.0, t_form=1.0):
+        self.N = N                              # Number of points in the domain
+        self.sigma = np.linspace(sigma_ratio[0], sigma_ratio[1], self.N)  # Cross section domain
         # Model parameters
-        self.sigma_0 = 0.0                      # Initial cross section
-        self.sigma_f = 1.0                      # Final cross section
-        self.t_prod = 0.0                       # Production time
-        self.t_form = 1.0                       # Formation time
+        self.sigma_0 = sigma_0                  # Initial cross section
+        self.sigma_f = sigma_f                  # Final cross section
+        self.t_prod = t_prod                    # Production time
+        self.t_form = t_form                    # Formation time
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the polynomial model matching a validated config.yaml dictionary."""
+        physics_parameters = config.get('physics_parameters', {})
+        sampling_parameters = config.get('sampling_parameters', {})
+        return cls(N=sampling_parameters.get('number_of_points_in_domain', 100),
+                   sigma_ratio=sampling_parameters.get('sigma_ratio', (0.01, 1)),
+                   sigma_0=physics_parameters.get('sigma_0', 0.0),
+                   sigma_f=physics_parameters.get('sigma_f', 1.0),
+                   t_prod=physics_parameters.get('production_time', 0.0),
+                   t_form=physics_parameters.get('formation_time', 1.0))
 
     def calculatePolynomialF_vs_t(self, t, alpha):
         """Polynomial evolution of sigma(t)."""
@@ -15,17 +28,75 @@ class PolynomialCrossSection:
         time_ratio = (t - self.t_prod) / (self.t_form - self.t_prod)
         polynomial_f = self.sigma_f * (1 - sigma_ratio) * (time_ratio ** alpha) + sigma_ratio
         return polynomial_f / self.sigma_f
-    
+
     def calculatePolynomialDsigmaDt_vs_sigma(self, alpha):
         """Polynomial evolution of dsigma/dt."""
         sigma_ratio = self.sigma_0 / self.sigma_f
         polynomial_A = alpha * (self.sigma_f / (self.t_form - self.t_prod)) * (1 - sigma_ratio)
         polynomial_dsigma_dt = polynomial_A * ((self.sigma * self.sigma_f - sigma_ratio + 1e-6)/(1.0 - sigma_ratio)) ** ((alpha - 1.0) / alpha)
         return polynomial_dsigma_dt
-    
+
     def calculatePolynomialDsigmaDt_vs_t(self, t, alpha):
         """Polynomial evolution of dsigma/dt."""
         sigma_ratio = self.sigma_0 / self.sigma_f
         polynomial_A = alpha * (self.sigma_f / (self.t_form - self.t_prod)) * (1 - sigma_ratio)
         polynomial_dsigma_dt = polynomial_A * (t ** (alpha - 1.0))
-        return polynomial_dsigma_dt
\ No newline at end of file
+        return polynomial_dsigma_dt
+
+    def calculateBatch(self, alphas, t):
+        """Evaluate the three polynomial forms for every alpha at once.
+
+        alphas may have any shape S and t is a 1D array of T times. Returns
+        sigma(t)/sigma_f and dsigma/dt vs t with shape S + (T,), and dsigma/dt
+        vs sigma with shape S + (N,), equal to calling the methods above
+        once per alpha.
+        """
+        alpha = np.asarray(alphas, dtype=np.float64)[..., np.newaxis]
+        t = np.asarray(t, dtype=np.float64)
+        sigma_ratio = self.sigma_0 / self.sigma_f
+        time_ratio = (t - self.t_prod) / (self.t_form - self.t_prod)
+        polynomial_A = alpha * (self.sigma_f / (self.t_form - self.t_prod)) * (1 - sigma_ratio)
+        # Terms independent of alpha are computed once
+        sigma_term = (self.sigma * self.sigma_f - sigma_ratio + 1e-6) / (1.0 - sigma_ratio)
+        F_vs_t = (self.sigma_f * (1 - sigma_ratio) * time_ratio ** alpha + sigma_ratio) / self.sigma_f
+        dsigma_dt_vs_t = polynomial_A * t ** (alpha - 1.0)
+        dsigma_dt_vs_sigma = polynomial_A * sigma_term ** ((alpha - 1.0) / alpha)
+        return F_vs_t, dsigma_dt_vs_t, dsigma_dt_vs_sigma
+
+class PolynomialCrossSectionTable:
+    def __init__(self, model, alphas, t):
+        """Precomputed baseline curves of a PolynomialCrossSection on a grid of alphas.
+
+        Curves at tabulated alphas are returned as stored; in between, they
+        are linearly interpolated in alpha, so dense comparisons against
+        many GP trajectories reuse the same table instead of re-evaluating
+        the powers.
+        """
+        self.alphas = np.sort(np.asarray(alphas, dtype=np.float64))
+        if len(self.alphas) < 2:
+            raise ValueError("PolynomialCrossSectionTable needs at least two alphas")
+        self.t = np.asarray(t, dtype=np.float64)
+        self.sigma = model.sigma
+        self.F_vs_t, self.dsigma_dt_vs_t, self.dsigma_dt_vs_sigma = model.calculateBatch(self.alphas, self.t)
+
+    def evaluate(self, alphas):
+        """Curves at the given alphas (clipped to the tabulated range), shapes as in calculateBatch."""
+        alphas = np.clip(np.asarray(alphas, dtype=np.float64), self.alphas[0], self.alphas[-1])
+        j = np.clip(np.searchsorted(self.alphas, alphas), 1, len(self.alphas) - 1)
+        width = self.alphas[j] - self.alphas[j - 1]
+        weight = np.divide(alphas - self.alphas[j - 1], width, out=np.ones_like(alphas), where=width > 0)[..., np.newaxis]
+        return tuple(table[j - 1] + weight * (table[j] - table[j - 1])
+                     for table in [self.F_vs_t, self.dsigma_dt_vs_t, self.dsigma_dt_vs_sigma])
+
+    def save(self, path):
+        np.savez(path, alphas=self.alphas, t=self.t, sigma=self.sigma, F_vs_t=self.F_vs_t,
+                 dsigma_dt_vs_t=self.dsigma_dt_vs_t, dsigma_dt_vs_sigma=self.dsigma_dt_vs_sigma)
+
+    @classmethod
+    def load(cls, path):
+        """Load a table written by save."""
+        table = cls.__new__(cls)
+        with np.load(path) as data:
+            for name in data.files:
+                setattr(table, name, data[name])
+        return table
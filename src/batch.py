@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#-----------------------------------------------------------------------------------------------
+#version: 1.0.0
+#-----------------------------------------------------------------------------------------------
+# |Gaussian Process Generator batch|
+# ----------------
+# Runs many config files in a single process pool, each as main.py would.
+# The specifications are loaded once to validate every config, configs sharing
+# a grid and kernel (same factorization_key) are factorized once, and each config
+# writes its outputs and status.yaml to <out>/<config name>/. A summary of the
+# batch, with its throughput, is written to <out>/batch_status.yaml.
+#
+# Configs are given as files, directories (all their .yaml files) or a manifest
+# listing one config path per line (relative to the manifest, '#' for comments).
+#
+# Ex.:
+# $> python src/batch.py input/configs/ --workers 4
+# $> python src/batch.py --manifest input/manifest.txt
+################################################################################################
+
+import sys as sys
+import os as os
+import copy as copy
+import collections as collections
+import time as time
+import argparse as argparse
+import multiprocessing as multiprocessing
+import multiprocessing.resource_tracker
+import yaml as yaml
+
+# Determine current path to define all other paths relative to it
+pwd = os.path.abspath(os.path.dirname(__file__))
+home_path = pwd[:pwd.rindex('/') + 1]
+
+api_path = os.path.join(home_path, 'api/')
+src_path = os.path.join(home_path, 'src/')
+out_path = os.path.join(home_path, 'output/')
+cache_path = os.path.join(home_path, 'cache/')
+
+from GaussianProcessCrossSectionGenerator import *
+from GaussianProcessCrossSectionCache import *
+from GaussianProcessCrossSectionInstrumentation import *
+from GaussianProcessCrossSectionRunner import *
+from GaussianProcessCrossSectionTabulator import share_factor, attach_factor, release_factor
+sys.path.append(api_path)
+from OpenAPI_Specifications_validator import *
+
+def collect_config_paths(paths, manifest=None):
+    """Config files given directly, found in directories, or listed in a manifest."""
+    config_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            config_paths += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(('.yaml', '.yml')))
+        else:
+            config_paths.append(path)
+    if manifest is not None:
+        with open(manifest, 'r') as manifest_file:
+            for line in manifest_file:
+                line = line.split('#')[0].strip()
+                if line:
+                    config_paths.append(os.path.join(os.path.dirname(os.path.abspath(manifest)), line))
+    return config_paths
+
+def output_names(config_paths):
+    """Output directory name of each config: its file name, numbered if repeated."""
+    names = []
+    for path in config_paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        candidate, i = name, 1
+        while candidate in names:
+            i += 1
+            candidate = "%s_%d" % (name, i)
+        names.append(candidate)
+    return names
+
+def run_batch_config(name, config, config_out_path, GP, cache, factor=None):
+    """Run one config in a pool worker and write its status.yaml; return its summary.
+
+    GP, if given, is the factorization shared by the config's group, with
+    its Cholesky factor in shared memory (factor, see share_factor).
+    """
+    wall_start = time.perf_counter()
+    log = lambda message: print("[batch.py]> %s: %s" % (name, message))
+    runtime_parameters = config.get("runtime_parameters", {})
+    profile_stage = runtime_parameters.get("profile_stage")
+    if runtime_parameters.get("instrumentation", False) or profile_stage is not None:
+        enable_instrumentation(profile_stage)
+    status = {"code": 200, "message": "Succcessful module execution"}
+    shm = None
+    try:
+        if GP is not None:
+            GP = GP.copyForConfig(config)
+            shm = attach_factor(GP, factor)
+        status.update(run_gp_cross_section(config, config_out_path, cache, os.path.join(cache_path, 'results'),
+                                           [src_path, api_path], GP, log))
+    except Exception as e:
+        status = {"code": 500, "message": "[batch.py]> " + repr(e)}
+    finally:
+        if shm is not None:
+            GP.LMatrix = None
+            shm.close()
+    if instrumentation_enabled():
+        status["stages"] = instrumentation_report()
+        if profile_stage is not None:
+            profile = dump_profile(os.path.join(config_out_path, "profile_" + profile_stage + ".prof"))
+            if profile is not None:
+                status["profile"] = profile
+        disable_instrumentation()
+    with open(os.path.join(config_out_path, "status.yaml"), 'w') as outfile:
+        yaml.dump(status, outfile, default_flow_style=False, sort_keys=False)
+    return {"name": name, "code": status["code"], "message": status["message"],
+            "wall_time": time.perf_counter() - wall_start, "result_cache": status.get("result_cache")}
+
+#======#
+# MAIN #
+#======#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run many Gaussian Process cross-section configs in one process pool")
+    parser.add_argument('configs', nargs='*', help="config files, or directories of config files")
+    parser.add_argument('--manifest', help="file listing one config path per line")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of configs run concurrently")
+    parser.add_argument('--out', default=os.path.join(out_path, 'batch'), help="directory of the per-config outputs")
+    parser.add_argument('--cache-size-MB', type=float, default=1024, help="Cholesky cache size (0 disables it)")
+    args = parser.parse_args()
+
+    batch_start = time.perf_counter()
+    config_paths = collect_config_paths(args.configs, args.manifest)
+    if not config_paths:
+        sys.exit("[batch.py]> No config files given \n\nOPERATION ABORTED")
+    names = output_names(config_paths)
+
+    # Validating every config against the specifications, loaded once
+    #------------------------------------------------------------------
+    openapi_specs = load_specifications(os.path.join(api_path, 'OpenAPI_Specifications.yaml'), os.path.join(cache_path, 'validation'))
+    tasks = []
+    summaries = []
+    for name, path in zip(names, config_paths):
+        config_out_path = os.path.join(args.out, name)
+        os.makedirs(config_out_path, exist_ok=True)
+        try:
+            with open(path, 'r') as config_file:
+                config, errors = validate_input_data(openapi_specs, '/input/config.yaml', yaml.safe_load(config_file))
+        except (OSError, yaml.YAMLError) as e:
+            config, errors = None, "\n  -> " + repr(e)
+        if errors != "":
+            status = {"code": 400, "message": "[batch.py]> Invalid config '" + path + "':" + errors}
+            with open(os.path.join(config_out_path, "status.yaml"), 'w') as outfile:
+                yaml.dump(status, outfile, default_flow_style=False)
+            summaries.append({"name": name, "code": 400, "message": status["message"], "wall_time": 0.0, "result_cache": None})
+            continue
+        # The pool is the parallelism of the batch; configs run one process each
+        config = copy.deepcopy(config)
+        config.setdefault("runtime_parameters", {})["workers"] = 1
+        tasks.append((name, config, config_out_path))
+    validation_time = time.perf_counter() - batch_start
+    print("[batch.py]> %d config(s) validated in %.3f s, %d invalid" % (len(config_paths), validation_time, len(summaries)))
+
+    # Running the configs, grouped by factorization
+    #-----------------------------------------------
+    cache = CholeskyCache(os.path.join(cache_path, 'cholesky'), int(args.cache_size_MB * 1024 ** 2)) if args.cache_size_MB > 0 else None
+    groups = {}
+    for task in tasks:
+        # Sweeps factorize each of their points themselves
+        key = None if "sweep_parameters" in task[1] else factorization_key(task[1])
+        groups.setdefault(key, []).append(task)
+    factorizations = 0
+    # Started before the pool, so workers attaching to shared factors register
+    # them with the tracker of this process instead of starting their own
+    multiprocessing.resource_tracker.ensure_running()
+    processes = max(1, min(args.workers, len(tasks)))
+    with multiprocessing.Pool(processes) as pool:
+        # Groups whose configs are queued or running, oldest first; at most
+        # one per worker, so at most that many shared factors exist at a time
+        pending = collections.deque()
+
+        def collect_oldest_group():
+            results, LMatrix, shm = pending.popleft()
+            summaries.extend(result.get() for result in results)
+            # The group's workers are done with its factor
+            release_factor(shm)
+
+        for key, group in groups.items():
+            while len(pending) >= processes:
+                collect_oldest_group()
+            GP, LMatrix, factor, shm = None, None, None, None
+            if key is not None:
+                # Factorized once here, while the pool runs the previous groups
+                try:
+                    GP = GaussianProcessCrossSection.from_config(group[0][1], cache=cache)
+                    factorizations += 1
+                    # The factor goes to the workers once, through shared memory,
+                    # and the covariance matrix not at all
+                    GP.SigmaMatrix = None
+                    LMatrix, factor, shm = share_factor(GP)
+                    if shm is not None:
+                        # Workers use the shared copy
+                        LMatrix = None
+                except Exception as e:
+                    print("[batch.py]> Factorization failed for %d config(s): %r" % (len(group), e))
+            results = [pool.apply_async(run_batch_config, (name, config, config_out_path, GP, cache, factor))
+                       for name, config, config_out_path in group]
+            # A factor mapped from a file is kept until the group is done, as a
+            # temporary file backing it would be removed otherwise
+            pending.append((results, LMatrix, shm))
+        while pending:
+            collect_oldest_group()
+
+    # Writing the batch status
+    #--------------------------
+    wall_time = time.perf_counter() - batch_start
+    completed = [summary for summary in summaries if summary["code"] == 200]
+    completed_names = {summary["name"] for summary in completed}
+    #Samples generated by the completed (non-sweep) configs
+    n_samples = sum(config.get("sampling_parameters", {}).get("number_of_samples", 200) for name, config, _ in tasks
+                    if name in completed_names and "sweep_parameters" not in config)
+    batch_status = {"configs": len(summaries), "completed": len(completed), "failed": len(summaries) - len(completed),
+                    "factorizations": factorizations, "workers": args.workers,
+                    "result_cache_hits": sum(summary["result_cache"] == "hit" for summary in summaries),
+                    "validation_time": round(validation_time, 6), "wall_time": round(wall_time, 6),
+                    "configs_per_second": round(len(completed) / wall_time, 6),
+                    "samples_per_second": round(n_samples / wall_time, 6),
+                    "runs": {summary["name"]: {"code": summary["code"], "message": summary["message"],
+                                               "wall_time": round(summary["wall_time"], 6)} for summary in summaries}}
+    with open(os.path.join(args.out, "batch_status.yaml"), 'w') as outfile:
+        yaml.dump(batch_status, outfile, default_flow_style=False, sort_keys=False)
+    print("[batch.py]> %(completed)d of %(configs)d config(s) completed with %(factorizations)d factorization(s) in %(wall_time).3f s: %(configs_per_second).2f configs/s, %(samples_per_second).0f samples/s" % batch_status)
+    print("[batch.py]> Batch status written to %s" % os.path.join(args.out, "batch_status.yaml"))
@@ -7,6 +7,7 @@
 # ----------------
 # Main script called to run the module.
 # Relies on functions defined in:
+# - src/GaussianProcessCrossSectionRunner.py
 # - src/GaussianProcessCrossSectionGenerator.py
 # - src/GaussianProcessCrossSectionTabulator.py
 # - src/GaussianProcessCrossSectionPlotter.py
@@ -22,6 +23,7 @@
 
 import sys as sys
 import os as os
+import time as time
 import yaml as yaml
 import subprocess as sub
 
@@ -33,12 +35,16 @@ api_path = os.path.join(home_path, 'api/')
 inp_path = os.path.join(home_path, 'input/')
 out_path = os.path.join(home_path, 'output/')
 src_path = os.path.join(home_path, 'src/')
+cache_path = os.path.join(home_path, 'cache/')
 
 # Add path to the libraries with converting functions
+# (tabulator, plotter and sweep modules, which pull in pandas and matplotlib,
+# are imported in the stage that uses them)
 from GaussianProcessCrossSectionGenerator import *
-from GaussianProcessCrossSectionTabulator import *
-from GaussianProcessCrossSectionPlotter import *
+from GaussianProcessCrossSectionCache import *
+from GaussianProcessCrossSectionInstrumentation import *
 from PolynomialCrossSectionGenerator import *
+from GaussianProcessCrossSectionRunner import *
 sys.path.append(api_path)
 from OpenAPI_Specifications_validator import *
 
@@ -64,12 +70,17 @@ for arg in args:
 # Ensuring inputs are valid
 #---------------------------
 
+#Validation is timed before knowing whether instrumentation is requested
+validation_wall_start, validation_cpu_start = time.perf_counter(), time.process_time()
+
 #Define path to module specifications
 specifications = os.path.join(api_path, 'OpenAPI_Specifications.yaml')
 
+#Validated specifications and inputs are cached, keyed by their content
+validation_cache_path = os.path.join(cache_path, 'validation')
+
 #Extract specifications from file
-with open(specifications, 'r') as spec_file:
-    openapi_specs = Spec.from_file(spec_file)
+openapi_specs = load_specifications_dict(specifications, validation_cache_path)
 
 #Dictionnary to store information on input files from specifications
 spec_input_files = {}
@@ -84,7 +95,7 @@ for path in openapi_specs["paths"].keys():
 #Looping over input files
 for arg in args:
     #Validate input file against module's OpenAPI specifications 
-    valid_input = OpenAPI_validator(specifications, arg, verbose=True)
+    valid_input = OpenAPI_validator(specifications, arg, verbose=True, cache_dir=validation_cache_path)
     #Loop over input files from specs
     for input_file in spec_input_files.keys():
         #Mark file as called if positive
@@ -92,7 +103,7 @@ for arg in args:
             spec_input_files[input_file]["called"] = True
     #Assign name of new validated + unmarshaled input files
     if "config.yaml" in arg: 
-        input_user = valid_input
+        input_user = os.path.join(os.path.dirname(arg), valid_input)
 
 #Loop over input files info from specs
 for input_file in spec_input_files.keys():
@@ -106,14 +117,29 @@ for input_file in spec_input_files.keys():
 #--------------#
 # INPUT PARSER #
 #--------------#
+with open(input_user, 'r') as config_file:
+    config = yaml.safe_load(config_file)
+runtime_parameters = config.get("runtime_parameters", {})
+
+#Record wall time, CPU time, peak memory and counts of each stage (and optionally profile one)
+profile_stage = runtime_parameters.get("profile_stage")
+if runtime_parameters.get("instrumentation", False) or profile_stage is not None:
+    enable_instrumentation(profile_stage)
+    record_stage("validation", time.perf_counter() - validation_wall_start, time.process_time() - validation_cpu_start, len(args))
+
 #------------------#
 # RUNNING THE CODE #
 #------------------#
 
-#Define command line to execute 
-CrossSection = GaussianProcessCrossSection()
-tabulate_gp_cross_section(CrossSection, out_path)
-plot_gp_cross_section(out_path)
+#Reuse Cholesky factors from previous runs when the cache is enabled
+cache_size = runtime_parameters.get("cholesky_cache_size_MB", 1024)
+cache = CholeskyCache(os.path.join(cache_path, 'cholesky'), int(cache_size * 1024 ** 2)) if cache_size > 0 else None
+
+#Run the config: a sweep, or tabulation and plots (outputs of identical seeded runs come from the result cache)
+run_status = run_gp_cross_section(config, out_path, cache, os.path.join(cache_path, 'results'), [src_path, api_path],
+                                  log=lambda message: print("[main.py]> " + message))
+if cache is not None:
+    print("[main.py]> Cholesky cache: %(hits)d hit(s), %(misses)d miss(es), %(load_time).3f s loading, %(store_time).3f s storing" % cache.report())
     
 #----------------#
 # OUTPUT PLOTTER #
@@ -123,7 +149,20 @@ plot_gp_cross_section(out_path)
 #----------------------------------------------#
 # WRITING STATUS FILE FOR SUCCESSFUL OPERATION #
 #----------------------------------------------#
+status = {"code":200, "message":"Succcessful module execution"}
+status.update(run_status)
+if instrumentation_enabled():
+    status["stages"] = instrumentation_report()
+    for name, entry in status["stages"].items():
+        print("[main.py]> %-13s %9.3f s wall %9.3f s CPU %8.0f MB peak %10d item(s)" % (name, entry["wall_time"], entry["cpu_time"], entry["peak_rss_MB"], entry["count"]))
+    if profile_stage is not None:
+        profile = dump_profile(os.path.join(out_path, "profile_" + profile_stage + ".prof"))
+        if profile is not None:
+            status["profile"] = profile
+            print("[main.py]> Profile of stage '%s' written to %s" % (profile_stage, profile))
+        else:
+            print("[main.py]> Stage '%s' did not run, no profile written" % profile_stage)
 with open(os.path.join(out_path, "status.yaml"), 'w') as outfile:
-    yaml.dump({"code":200, "message":"Succcessful module execution"}, outfile, default_flow_style=False)
+    yaml.dump(status, outfile, default_flow_style=False, sort_keys=False)
     
 print("")
\ No newline at end of file
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#-----------------------------------------------------------------------------------------------
+#version: 1.0.0
+#-----------------------------------------------------------------------------------------------
+# |Gaussian Process Generator service|
+# ----------------
+# Long-running local HTTP service implementing the endpoints of:
+# - api/OpenAPI_Specifications.yaml
+# The specifications are loaded once, and factorized GPs are kept in memory
+# between requests, so only the first request for a given grid and kernel
+# pays for the factorization.
+#
+#   PUT /input/config.yaml          validate a config (YAML or JSON) and queue a job
+#   GET /output/status.yaml         status of a job (?job=<id>, latest by default)
+#   GET /output/formation_times     times (t_prod + time_ratio * (t_form - t_prod)) of a
+#                                   finished job, streamed (?job=<id>&sample=<index>), or
+#                                   their mean, std and quantiles for statistics jobs
+#
+# Ex.:
+# $> python src/server.py --port 8000
+################################################################################################
+
+import sys as sys
+import os as os
+import json as json
+import queue as queue
+import argparse as argparse
+import threading as threading
+import multiprocessing as multiprocessing
+import itertools as itertools
+import collections as collections
+import concurrent.futures as futures
+import yaml as yaml
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Determine current path to define all other paths relative to it
+pwd = os.path.abspath(os.path.dirname(__file__))
+home_path = pwd[:pwd.rindex('/') + 1]
+
+api_path = os.path.join(home_path, 'api/')
+out_path = os.path.join(home_path, 'output/')
+cache_path = os.path.join(home_path, 'cache/')
+
+from GaussianProcessCrossSectionGenerator import *
+from GaussianProcessCrossSectionTabulator import *
+from GaussianProcessCrossSectionCache import *
+from GaussianProcessCrossSectionStatistics import load_gp_cross_section_statistics
+sys.path.append(api_path)
+from OpenAPI_Specifications_validator import *
+
+# Number of samples per streamed chunk of formation times
+STREAM_CHUNK_SIZE = 1000
+
+# Start method of the worker pools of jobs: forking this multithreaded process
+# could copy locks held by other threads into the workers
+JOB_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def GP_nbytes(GP):
+    """Memory held by the factors of a GP."""
+    return sum(getattr(GP, name).nbytes for name in ['LMatrix', 'SigmaMatrix', 'lowRankFactor', 'circulantRoot']
+               if getattr(GP, name, None) is not None)
+
+class GaussianProcessService:
+    def __init__(self, specifications, out_path, cache=None, job_workers=1, validation_cache_path=None,
+                 max_GP_bytes=1024 ** 3, max_finished_jobs=1000):
+        """Validated specs, warm GPs (at most max_GP_bytes of factors) and a queue of generation jobs.
+
+        Only the latest max_finished_jobs finished jobs are kept in the job
+        table; their outputs stay on disk.
+        """
+        self.openapi_specs = load_specifications(specifications, validation_cache_path)
+        self.out_path = out_path
+        self.cache = cache
+        # Futures of the factorized GPs, keyed by everything that determines the
+        # factorization, least recently used first
+        self.GPs = collections.OrderedDict()
+        self.GPs_lock = threading.Lock()
+        self.max_GP_bytes = max_GP_bytes
+        # Jobs by id, processed in order by the job workers
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.max_finished_jobs = max_finished_jobs
+        self.finished_jobs = collections.deque()
+        self.job_ids = itertools.count()
+        self.queue = queue.Queue()
+        for _ in range(job_workers):
+            threading.Thread(target=self.run_jobs, daemon=True).start()
+
+    def submit(self, data):
+        """Validate a config and queue it; return (job, errors)."""
+        config, errors = validate_input_data(self.openapi_specs, '/input/config.yaml', data)
+        if errors != "":
+            return None, errors
+        job = {"id": next(self.job_ids), "config": config, "status": "queued", "code": 202, "message": "Queued"}
+        job["path"] = os.path.join(self.out_path, 'jobs', str(job["id"]))
+        with self.jobs_lock:
+            self.jobs[job["id"]] = job
+        self.queue.put(job)
+        return job, ""
+
+    def get_GP(self, config):
+        """Return a GP for config, reusing a warm factorization when possible.
+
+        A factorization runs outside the lock, so it only blocks the jobs
+        waiting for the same key. Physics parameters and constraints are set
+        on a shallow copy, so they never require a new factorization.
+        """
+        key = factorization_key(config)
+        with self.GPs_lock:
+            future = self.GPs.get(key)
+            factorize = future is None
+            if factorize:
+                future = self.GPs[key] = futures.Future()
+            else:
+                self.GPs.move_to_end(key)
+        if factorize:
+            try:
+                GP = GaussianProcessCrossSection.from_config(config, cache=self.cache)
+                # Sampling only needs the factor
+                GP.SigmaMatrix = None
+            except Exception as e:
+                with self.GPs_lock:
+                    del self.GPs[key]
+                future.set_exception(e)
+                raise
+            future.set_result(GP)
+            self.evict_GPs(key)
+        return future.result().copyForConfig(config)
+
+    def evict_GPs(self, keep):
+        """Drop the least recently used warm GPs (but keep) until they fit in max_GP_bytes."""
+        with self.GPs_lock:
+            sizes = {key: GP_nbytes(future.result()) for key, future in self.GPs.items() if future.done()}
+            total = sum(sizes.values())
+            for key, size in sizes.items():
+                if total <= self.max_GP_bytes:
+                    break
+                if key != keep:
+                    del self.GPs[key]
+                    total -= size
+
+    def run_jobs(self):
+        """Job worker: generate queued configs into out_path/jobs/<id>/."""
+        while True:
+            job = self.queue.get()
+            job.update(status="running", code=102, message="Running")
+            os.makedirs(job["path"], exist_ok=True)
+            try:
+                config = job["config"]
+                sampling_parameters = config.get("sampling_parameters", {})
+                runtime_parameters = config.get("runtime_parameters", {})
+                GP = self.get_GP(config)
+                # Trajectories are kept in binary form, unless only statistics are requested
+                job["output_format"] = 'statistics' if runtime_parameters.get("output_format") == 'statistics' else 'binary'
+                tabulate_gp_cross_section(GP, job["path"], sampling_parameters.get("number_of_samples", 200), job["output_format"],
+                                          runtime_parameters.get("chunk_size"), runtime_parameters.get("seed"),
+                                          runtime_parameters.get("workers", 1), sampling_parameters.get("A_range", [1, 1]),
+                                          sampling_parameters.get("B_ratio_range", [0, 1]),
+                                          runtime_parameters.get("statistics_time_points", 100), runtime_parameters.get("sketch_size", 200),
+                                          pipeline=runtime_parameters.get("pipeline", False), start_method=JOB_START_METHOD)
+                job.update(status="completed", code=200, message="Succcessful module execution", t_prod=GP.t_prod, t_form=GP.t_form)
+            except Exception as e:
+                job.update(status="failed", code=500, message="[server.py]> " + repr(e))
+            with open(os.path.join(job["path"], "status.yaml"), 'w') as outfile:
+                yaml.dump({"code": job["code"], "message": job["message"]}, outfile, default_flow_style=False)
+            # Forget the oldest finished jobs
+            with self.jobs_lock:
+                self.finished_jobs.append(job["id"])
+                while len(self.finished_jobs) > self.max_finished_jobs:
+                    del self.jobs[self.finished_jobs.popleft()]
+            self.queue.task_done()
+
+    def find_job(self, query):
+        """Job selected by the ?job= query parameter, or the latest one (ValueError if not an integer)."""
+        with self.jobs_lock:
+            if "job" in query:
+                return self.jobs.get(int(query["job"][0]))
+            return self.jobs[max(self.jobs)] if self.jobs else None
+
+    def formation_time_statistics(self, job):
+        """Mean, std and quantiles of the formation times at each sigma of a statistics job."""
+        summary = load_gp_cross_section_statistics(job["path"])
+        scale = job["t_form"] - job["t_prod"]
+        # NaN is not valid JSON
+        to_list = lambda values: [None if np.isnan(value) else float(value) for value in values]
+        return {"sigma": to_list(summary["sigma"]),
+                "formation_times": to_list(job["t_prod"] + summary["time_ratio_mean"] * scale),
+                "std": to_list(summary["time_ratio_std"] * abs(scale)),
+                "quantiles": {"%g" % level: to_list(job["t_prod"] + values * scale)
+                              for level, values in zip(summary["quantiles"], summary["time_ratio_quantiles"])}}
+
+    def stream_formation_times(self, job, time_ratio, sample=None):
+        """Yield the JSON response for a finished job in chunks of samples."""
+        rows = [sample] if sample is not None else range(time_ratio.shape[0])
+        yield '{"formation_times": ['
+        for start in range(0, len(rows), STREAM_CHUNK_SIZE):
+            times = job["t_prod"] + np.asarray(time_ratio[rows[start:start + STREAM_CHUNK_SIZE]]) * (job["t_form"] - job["t_prod"])
+            # NaN is not valid JSON
+            text = ', '.join('null' if np.isnan(value) else repr(float(value)) for value in times.ravel())
+            yield (', ' if start > 0 else '') + text
+        yield ']}'
+
+class GaussianProcessRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def send_json(self, code, body):
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        if url.path != '/input/config.yaml':
+            return self.send_json(404, {"code": 404, "message": "[server.py]> Unknown path " + url.path})
+        try:
+            data = yaml.safe_load(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except yaml.YAMLError as e:
+            return self.send_json(400, {"code": 400, "message": "[server.py]> Could not parse request body: " + str(e)})
+        job, errors = self.service.submit(data)
+        if job is None:
+            return self.send_json(400, {"code": 400, "message": "Failed to validate config.yaml with module specifications.\n" + errors})
+        self.send_json(200, {"job": job["id"], "status": job["status"]})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path not in ['/output/status.yaml', '/output/formation_times']:
+            return self.send_json(404, {"code": 404, "message": "[server.py]> Unknown path " + url.path})
+        try:
+            job = self.service.find_job(query)
+            sample = int(query["sample"][0]) if "sample" in query else None
+        except ValueError:
+            return self.send_json(400, {"code": 400, "message": "[server.py]> job and sample must be integers"})
+        if job is None:
+            return self.send_json(404, {"code": 404, "message": "[server.py]> No such job"})
+        if url.path == '/output/status.yaml':
+            return self.send_json(200, {"job": job["id"], "status": job["status"], "code": job["code"], "message": job["message"]})
+        if job["status"] != "completed":
+            return self.send_json(409, {"job": job["id"], "status": job["status"], "message": "[server.py]> Job not completed"})
+        if job["output_format"] == 'statistics':
+            if sample is not None:
+                return self.send_json(400, {"code": 400, "message": "[server.py]> Job %d only kept ensemble statistics" % job["id"]})
+            return self.send_json(200, self.service.formation_time_statistics(job))
+        # Checked before the response starts, errors cannot be reported once it is streamed
+        time_ratio = load_gp_cross_section(job["path"])['time_ratio']
+        if sample is not None and not 0 <= sample < time_ratio.shape[0]:
+            return self.send_json(400, {"code": 400, "message": "[server.py]> Job %d has no sample %d (%d samples)" % (job["id"], sample, time_ratio.shape[0])})
+        # Stream the times with chunked transfer encoding
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for text in self.service.stream_formation_times(job, time_ratio, sample):
+            content = text.encode()
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(content), content))
+        self.wfile.write(b'0\r\n\r\n')
+
+#======#
+# MAIN #
+#======#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Gaussian Process cross-section generation service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--job-workers', type=int, default=1, help="number of jobs generated concurrently")
+    parser.add_argument('--cache-size-MB', type=float, default=1024, help="Cholesky cache size (0 disables it)")
+    parser.add_argument('--GP-memory-MB', type=float, help="memory kept by warm factorizations (the Cholesky cache size by default)")
+    parser.add_argument('--max-finished-jobs', type=int, default=1000, help="finished jobs kept in the job table, oldest first out")
+    args = parser.parse_args()
+
+    cache = CholeskyCache(os.path.join(cache_path, 'cholesky'), int(args.cache_size_MB * 1024 ** 2)) if args.cache_size_MB > 0 else None
+    GaussianProcessRequestHandler.service = GaussianProcessService(os.path.join(api_path, 'OpenAPI_Specifications.yaml'),
+                                                                   out_path, cache, args.job_workers,
+                                                                   os.path.join(cache_path, 'validation'),
+                                                                   int((args.cache_size_MB if args.GP_memory_MB is None else args.GP_memory_MB) * 1024 ** 2),
+                                                                   args.max_finished_jobs)
+    server = ThreadingHTTPServer((args.host, args.port), GaussianProcessRequestHandler)
+    print("[server.py]> Serving on http://%s:%d" % (args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Modules are run as scripts from src/ and api/, and import each other by name
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(root, 'src'), os.path.join(root, 'api')]
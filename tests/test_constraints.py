@@ -0,0 +1,52 @@
+import warnings
+import numpy as np
+import pytest
+from GaussianProcessCrossSectionGenerator import GaussianProcessCrossSection
+from GaussianProcessCrossSectionTabulator import tabulate_gp_cross_section, load_gp_cross_section
+
+def constrained_config(quantity, values, **sampling_parameters):
+    return {
+        'GP_parameters': {'l': 0.2, 'kappa': 1.0, 'xi': 1e-6},
+        'sampling_parameters': dict({'number_of_points_in_domain': 200, 'sigma_ratio': [0.01, 1.0],
+                                     'B_ratio_range': [0.0, 1.0]}, **sampling_parameters),
+        'physics_parameters': {'production_time': 1.0, 'formation_time': 3.0},
+        'constraint_parameters': {'sigma': [0.2, 0.8], 'values': values, 'quantity': quantity},
+    }
+
+def tabulate(config, out_path, n_samples=200):
+    GP = GaussianProcessCrossSection.from_config(config)
+    with warnings.catch_warnings():
+        # Samples that miss their targets are reported with a warning
+        warnings.simplefilter('error')
+        tabulate_gp_cross_section(GP, str(out_path), n_samples, 'binary', chunk_size=64, seed=1,
+                                  B_ratio_range=config['sampling_parameters']['B_ratio_range'])
+    data = load_gp_cross_section(str(out_path))
+    # Written outputs at the output points nearest the constraints
+    points = np.abs(data['sigma'][:, np.newaxis] - np.array([0.2, 0.8])).argmin(axis=0)
+    return data, points
+
+@pytest.mark.parametrize('grid', [{}, {'output_sigma': np.linspace(0.01, 1.0, 77).tolist()}])
+def test_dsigma_dt_constraints_hold_in_written_outputs(tmp_path, grid):
+    data, points = tabulate(constrained_config('dsigma_dt', [0.5, 2.0], **grid), tmp_path)
+    np.testing.assert_allclose(data['dsigma_dt'][:, points], np.broadcast_to([0.5, 2.0], (200, 2)), rtol=1e-7)
+
+def test_phi_constraints_hold_in_written_outputs(tmp_path):
+    data, points = tabulate(constrained_config('phi', [0.0, 1.0]), tmp_path)
+    A, B = data['A'][:, np.newaxis], data['B'][:, np.newaxis]
+    np.testing.assert_allclose(data['dsigma_dt'][:, points], A / (np.exp([0.0, 1.0]) + B), rtol=1e-7)
+
+@pytest.mark.parametrize('grid', [{}, {'output_sigma': np.linspace(0.01, 1.0, 77).tolist()}])
+def test_time_constraints_hold_in_written_outputs(tmp_path, grid):
+    # 1.6 and 2.6 between production_time 1 and formation_time 3
+    data, points = tabulate(constrained_config('time', [1.6, 2.6], **grid), tmp_path)
+    np.testing.assert_allclose(data['time_ratio'][:, points], np.broadcast_to([0.3, 0.8], (200, 2)), atol=1e-9)
+    # Endpoints hold by construction
+    np.testing.assert_array_equal(data['time_ratio'][:, 0], 0)
+    np.testing.assert_allclose(data['time_ratio'][:, -1], 1)
+
+def test_time_constraints_at_the_ends_must_match_production_and_formation_times():
+    GP = GaussianProcessCrossSection.from_config(constrained_config('time', [1.6, 2.6]))
+    GP.setConstraints([0.01, 0.5, 1.0], [1.0, 2.0, 3.0], 'time')
+    assert GP.sigma[GP.constraintIndices].tolist() == [GP.sigma[np.abs(GP.sigma - 0.5).argmin()]]
+    with pytest.raises(ValueError):
+        GP.setConstraints([1.0], [2.5], 'time')
@@ -0,0 +1,32 @@
+import os
+import pytest
+from OpenAPI_Specifications_validator import load_specifications, validate_input_data
+
+SPECS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api', 'OpenAPI_Specifications.yaml')
+
+@pytest.fixture(scope='module')
+def specs():
+    return load_specifications(SPECS_PATH)
+
+def sweep_config(**sweep_parameters):
+    return {'GP_parameters': {'l': 1.0, 'kappa': 10.0, 'xi': 1.0e-06},
+            'sampling_parameters': {'number_of_points_in_domain': 100, 'number_of_samples': 10},
+            'sweep_parameters': sweep_parameters}
+
+def test_sweep_within_bounds_is_valid(specs):
+    valid_body, errors = validate_input_data(specs, '/input/config.yaml', sweep_config(l=[0.5, 1.0], kappa=[5.0, 10.0], xi=[1.0e-06]))
+    assert errors == ''
+    assert valid_body is not None
+
+@pytest.mark.parametrize('sweep_parameters', [{'l': [0.5, 0.0]}, {'l': [-1.0]}, {'kappa': [1000.0]}, {'xi': [1.0]}])
+def test_sweep_values_out_of_range_are_rejected(specs, sweep_parameters):
+    valid_body, errors = validate_input_data(specs, '/input/config.yaml', sweep_config(**sweep_parameters))
+    assert errors != ''
+    assert valid_body is None
+
+def test_adaptive_grids_above_the_dense_limit_are_rejected(specs):
+    config = sweep_config()
+    del config['sweep_parameters']
+    config['sampling_parameters'].update({'grid': 'adaptive', 'max_points_in_domain': 2000})
+    valid_body, errors = validate_input_data(specs, '/input/config.yaml', config)
+    assert errors != ''